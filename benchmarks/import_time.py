@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SCENARIOS: Dict[str, List[str]] = {
+    'help': ['run.py', '--help'],
+    'headless-swap': ['-c', 'import sys; sys.argv = ["run.py", "-s", "source.jpg", "-t", "target.mp4", "-o", "output.mp4", "--frame-processor", "face_swapper"]; import roop.globals; from roop import core; core.parse_args(); core.get_frame_processors_modules(roop.globals.frame_processors)'],
+    'gui': ['-c', 'import sys; sys.argv = ["run.py"]; import roop.globals; from roop import core; core.parse_args(); core.get_frame_processors_modules(roop.globals.frame_processors); import roop.ui']
+}
+
+
+def run_scenario(arguments: List[str]) -> Tuple[float, str]:
+    start_time = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime'] + arguments, cwd=ROOT_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start_time
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f'exit code {completed.returncode}')
+    return elapsed, completed.stderr
+
+
+def get_slowest_imports(import_log: str, limit: int) -> List[Tuple[str, float]]:
+    imports = []
+    for line in import_log.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if (len(name) - len(name.lstrip()) - 1) // 2 != 1:
+            continue
+        imports.append((name.strip(), int(cumulative) / 1000000))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:limit]
+
+
+def benchmark_scenario(name: str, runs: int, top: int) -> Dict[str, object]:
+    timings = []
+    import_log = ''
+    for _ in range(runs):
+        elapsed, import_log = run_scenario(SCENARIOS[name])
+        timings.append(elapsed)
+    return {
+        'scenario': name,
+        'runs': runs,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+        'slowest_imports': get_slowest_imports(import_log, top)
+    }
+
+
+def main() -> None:
+    program = argparse.ArgumentParser(description='measure the cold start time of roop')
+    program.add_argument('--scenario', help='scenarios to run', dest='scenarios', default=list(SCENARIOS), choices=list(SCENARIOS), nargs='+')
+    program.add_argument('--runs', help='runs per scenario', dest='runs', type=int, default=5)
+    program.add_argument('--top', help='number of slowest imports directly below the top level to list', dest='top', type=int, default=5)
+    program.add_argument('--output', help='write the results to a json file', dest='output_path')
+    args = program.parse_args()
+
+    results = []
+    for name in args.scenarios:
+        try:
+            result = benchmark_scenario(name, args.runs, args.top)
+        except RuntimeError as exception:
+            print(f'{name:<16} failed: {exception}')
+            continue
+        results.append(result)
+        print(f'{name:<16} min {result["min"]:.3f}s  median {result["median"]:.3f}s  max {result["max"]:.3f}s')
+        for module_name, cumulative in result['slowest_imports']:
+            print(f'{"":<16} {cumulative:.3f}s  {module_name}')
+    if args.output_path:
+        with open(args.output_path, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
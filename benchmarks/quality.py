@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT_PATH)
+
+FACE_PADDING = 0.2
+MATCH_IOU = 0.5
+REFERENCE_FLAGS = ['--face-detection-interval', '1', '--swap-batch-size', '1', '--enhancer-batch-size', '1']
+FAST_PATH_FLAGS = ('--skip-duplicate-frames', '--face-cache')
+
+
+def trim_clip(target_path: str, clip_path: str, frame_total: int) -> None:
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', target_path, '-frames:v', str(frame_total), '-an', '-c:v', 'libx264', '-crf', '0', '-y', clip_path], check=True)
+
+
+def get_reference_flags(flags: List[str]) -> List[str]:
+    return [flag for flag in flags if flag not in FAST_PATH_FLAGS] + REFERENCE_FLAGS
+
+
+def render_clip(source_path: str, target_path: str, output_path: str, flags: List[str]) -> float:
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable, 'run.py', '-s', source_path, '-t', target_path, '-o', output_path, '--skip-audio', '--video-quality', '0'] + flags, cwd=ROOT_PATH, check=True)
+    return time.perf_counter() - start_time
+
+
+def read_frames(video_path: str) -> Iterator[Any]:
+    capture = cv2.VideoCapture(video_path)
+    try:
+        while True:
+            has_frame, frame = capture.read()
+            if not has_frame:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+def get_face_region(face: Any, frame_shape: Tuple[int, ...]) -> Tuple[int, int, int, int]:
+    start_x, start_y, end_x, end_y = face.bbox
+    padding_x = (end_x - start_x) * FACE_PADDING
+    padding_y = (end_y - start_y) * FACE_PADDING
+    frame_height, frame_width = frame_shape[:2]
+    return max(int(start_x - padding_x), 0), max(int(start_y - padding_y), 0), min(int(end_x + padding_x), frame_width), min(int(end_y + padding_y), frame_height)
+
+
+def calculate_ssim(frame: Any, other_frame: Any) -> float:
+    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY).astype(numpy.float64)
+    other_frame = cv2.cvtColor(other_frame, cv2.COLOR_BGR2GRAY).astype(numpy.float64)
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    mean = cv2.GaussianBlur(frame, (11, 11), 1.5)
+    other_mean = cv2.GaussianBlur(other_frame, (11, 11), 1.5)
+    variance = cv2.GaussianBlur(frame * frame, (11, 11), 1.5) - mean * mean
+    other_variance = cv2.GaussianBlur(other_frame * other_frame, (11, 11), 1.5) - other_mean * other_mean
+    covariance = cv2.GaussianBlur(frame * other_frame, (11, 11), 1.5) - mean * other_mean
+    ssim_map = ((2 * mean * other_mean + c1) * (2 * covariance + c2)) / ((mean * mean + other_mean * other_mean + c1) * (variance + other_variance + c2))
+    return float(ssim_map.mean())
+
+
+def calculate_identity(face: Any, source_face: Any) -> float:
+    return float(numpy.dot(face.normed_embedding, source_face.normed_embedding))
+
+
+def match_face(face: Any, faces: List[Any]) -> Optional[Any]:
+    from roop.face_analyser import calculate_iou
+
+    ious = [calculate_iou(face.bbox, other_face.bbox) for other_face in faces]
+    if ious and max(ious) >= MATCH_IOU:
+        return faces[int(numpy.argmax(ious))]
+    return None
+
+
+def evaluate_frame(reference_frame: Any, fast_frame: Any, source_face: Any, identity_threshold: float) -> Dict[str, Any]:
+    from roop.face_analyser import get_many_faces
+
+    reference_faces = get_many_faces(reference_frame, 'recognition') or []
+    fast_faces = get_many_faces(fast_frame, 'recognition') or []
+    regions = []
+    swapped_total = 0
+    missed_total = 0
+    for reference_face in reference_faces:
+        start_x, start_y, end_x, end_y = get_face_region(reference_face, reference_frame.shape)
+        if end_x - start_x < 11 or end_y - start_y < 11:
+            continue
+        reference_region = reference_frame[start_y:end_y, start_x:end_x]
+        fast_region = fast_frame[start_y:end_y, start_x:end_x]
+        reference_identity = calculate_identity(reference_face, source_face)
+        fast_face = match_face(reference_face, fast_faces)
+        fast_identity = calculate_identity(fast_face, source_face) if fast_face is not None else None
+        if reference_identity >= identity_threshold:
+            swapped_total += 1
+            if fast_identity is None or fast_identity < identity_threshold:
+                missed_total += 1
+        regions.append({
+            'bbox': [start_x, start_y, end_x, end_y],
+            'ssim': calculate_ssim(reference_region, fast_region),
+            'psnr': float(cv2.PSNR(reference_region, fast_region)),
+            'reference_identity': reference_identity,
+            'fast_identity': fast_identity
+        })
+    return {'faces': regions, 'swapped': swapped_total, 'missed': missed_total}
+
+
+def get_mean(values: List[Optional[float]]) -> Optional[float]:
+    values = [value for value in values if value is not None]
+    return float(numpy.mean(values)) if values else None
+
+
+def summarize(frames: List[Dict[str, Any]]) -> Dict[str, Any]:
+    regions = [region for frame in frames for region in frame['faces']]
+    swapped_total = sum(frame['swapped'] for frame in frames)
+    return {
+        'frames': len(frames),
+        'faces': len(regions),
+        'ssim_mean': get_mean([region['ssim'] for region in regions]),
+        'ssim_min': min((region['ssim'] for region in regions), default=None),
+        'psnr_mean': get_mean([min(region['psnr'], 100.0) for region in regions]),
+        'reference_identity_mean': get_mean([region['reference_identity'] for region in regions]),
+        'fast_identity_mean': get_mean([region['fast_identity'] for region in regions]),
+        'miss_rate': sum(frame['missed'] for frame in frames) / swapped_total if swapped_total else 0.0
+    }
+
+
+def format_value(value: Optional[float]) -> str:
+    return f'{value:.4f}' if value is not None else '-'
+
+
+def main() -> None:
+    program = argparse.ArgumentParser(description='compare the output of a fast path against the reference path of roop')
+    program.add_argument('-s', '--source', help='source image', dest='source_path', required=True)
+    program.add_argument('-t', '--target', help='target video', dest='target_path', required=True)
+    program.add_argument('--frames', help='only evaluate the first frames of the target', dest='frames', type=int)
+    program.add_argument('--reference', help='roop arguments of the reference path, always run with full detection, no batching and no frame skipping', dest='reference_flags', default='')
+    program.add_argument('--fast', help='roop arguments of the fast path', dest='fast_flags', required=True)
+    program.add_argument('--identity-threshold', help='source similarity from which a face counts as swapped', dest='identity_threshold', type=float, default=0.3)
+    program.add_argument('--execution-provider', help='execution provider of the evaluation models', dest='execution_provider', default=['cpu'], nargs='+')
+    program.add_argument('--output', help='write the per frame results to a json file', dest='output_path')
+    args = program.parse_args()
+
+    import roop.globals
+    from roop.core import decode_execution_providers
+    from roop.face_analyser import get_one_face
+
+    roop.globals.execution_providers = decode_execution_providers(args.execution_provider)
+    source_face = get_one_face(cv2.imread(args.source_path), 'recognition')
+    if source_face is None:
+        sys.exit('No face in source path detected.')
+    source_path = os.path.abspath(args.source_path)
+    with tempfile.TemporaryDirectory() as work_path:
+        target_path = os.path.abspath(args.target_path)
+        if args.frames:
+            target_path = os.path.join(work_path, 'clip.mp4')
+            trim_clip(os.path.abspath(args.target_path), target_path, args.frames)
+        reference_path = os.path.join(work_path, 'reference.mp4')
+        fast_path = os.path.join(work_path, 'fast.mp4')
+        reference_time = render_clip(source_path, target_path, reference_path, get_reference_flags(shlex.split(args.reference_flags)))
+        fast_time = render_clip(source_path, target_path, fast_path, shlex.split(args.fast_flags))
+        frames = [evaluate_frame(reference_frame, fast_frame, source_face, args.identity_threshold) for reference_frame, fast_frame in zip(read_frames(reference_path), read_frames(fast_path))]
+    summary = summarize(frames)
+    summary['reference_seconds'] = reference_time
+    summary['fast_seconds'] = fast_time
+    print(f'frames {summary["frames"]}, faces {summary["faces"]}, reference {reference_time:.1f}s, fast {fast_time:.1f}s ({reference_time / fast_time:.2f}x)')
+    print(f'face region ssim mean {format_value(summary["ssim_mean"])}, min {format_value(summary["ssim_min"])}, psnr mean {format_value(summary["psnr_mean"])} dB')
+    print(f'source identity reference {format_value(summary["reference_identity_mean"])}, fast {format_value(summary["fast_identity_mean"])}')
+    print(f'miss rate {summary["miss_rate"]:.4f}')
+    if args.output_path:
+        with open(args.output_path, 'w') as output_file:
+            json.dump({'summary': summary, 'frames': frames}, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
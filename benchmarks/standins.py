@@ -0,0 +1,175 @@
+import os
+import shutil
+import subprocess
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy
+
+FACE_TEMPLATE = numpy.array([[38.2946, 51.6963], [73.5318, 51.5014], [56.0252, 71.7366], [41.5493, 92.3655], [70.7299, 92.2041]], dtype=numpy.float32)
+DETECTOR_SIZE = 640
+RECOGNIZER_SIZE = 112
+SWAPPER_SIZE = 128
+
+
+def create_conv(name: str, input_name: str, output_name: str, in_channels: int, out_channels: int, stride: int, initializers: List[Any]) -> Any:
+    from onnx import helper, numpy_helper
+
+    initializers.append(numpy_helper.from_array((numpy.random.standard_normal((out_channels, in_channels, 3, 3)) * 0.1).astype(numpy.float32), f'{name}_weight'))
+    initializers.append(numpy_helper.from_array(numpy.zeros(out_channels, dtype=numpy.float32), f'{name}_bias'))
+    return helper.make_node('Conv', [input_name, f'{name}_weight', f'{name}_bias'], [output_name], kernel_shape=[3, 3], strides=[stride, stride], pads=[1, 1, 1, 1])
+
+
+def save_model(graph: Any, model_path: str) -> None:
+    import onnx
+    from onnx import helper
+
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 8
+    onnx.save(model, model_path)
+
+
+def create_detector_model(model_path: str) -> None:
+    from onnx import TensorProto, helper
+
+    initializers: List[Any] = []
+    nodes = [
+        create_conv('conv1', 'input', 'conv1', 3, 16, 2, initializers),
+        helper.make_node('Relu', ['conv1'], ['relu1']),
+        create_conv('conv2', 'relu1', 'conv2', 16, 32, 2, initializers),
+        helper.make_node('Relu', ['conv2'], ['relu2']),
+        create_conv('conv3', 'relu2', 'conv3', 32, 32, 2, initializers),
+        helper.make_node('GlobalAveragePool', ['conv3'], ['score'])
+    ]
+    inputs = [helper.make_tensor_value_info('input', TensorProto.FLOAT, [1, 3, DETECTOR_SIZE, DETECTOR_SIZE])]
+    outputs = [helper.make_tensor_value_info('score', TensorProto.FLOAT, [1, 32, 1, 1])]
+    save_model(helper.make_graph(nodes, 'detector', inputs, outputs, initializers), model_path)
+
+
+def create_recognizer_model(model_path: str) -> None:
+    from onnx import TensorProto, helper, numpy_helper
+
+    initializers: List[Any] = []
+    nodes = [
+        create_conv('conv1', 'input', 'conv1', 3, 32, 2, initializers),
+        helper.make_node('Relu', ['conv1'], ['relu1']),
+        create_conv('conv2', 'relu1', 'conv2', 32, 64, 2, initializers),
+        helper.make_node('Relu', ['conv2'], ['relu2']),
+        helper.make_node('GlobalAveragePool', ['relu2'], ['pool']),
+        helper.make_node('Flatten', ['pool'], ['features']),
+        helper.make_node('Gemm', ['features', 'fc_weight'], ['embedding'])
+    ]
+    initializers.append(numpy_helper.from_array(numpy.random.standard_normal((64, 512)).astype(numpy.float32), 'fc_weight'))
+    inputs = [helper.make_tensor_value_info('input', TensorProto.FLOAT, ['batch', 3, RECOGNIZER_SIZE, RECOGNIZER_SIZE])]
+    outputs = [helper.make_tensor_value_info('embedding', TensorProto.FLOAT, ['batch', 512])]
+    save_model(helper.make_graph(nodes, 'recognizer', inputs, outputs, initializers), model_path)
+
+
+def create_swapper_model(model_path: str) -> None:
+    from onnx import TensorProto, helper, numpy_helper
+
+    initializers: List[Any] = []
+    nodes = [
+        create_conv('conv1', 'target', 'conv1', 3, 32, 1, initializers),
+        helper.make_node('Relu', ['conv1'], ['relu1']),
+        create_conv('conv2', 'relu1', 'conv2', 32, 32, 1, initializers),
+        helper.make_node('Relu', ['conv2'], ['relu2']),
+        create_conv('conv3', 'relu2', 'conv3', 32, 3, 1, initializers),
+        helper.make_node('Gemm', ['source', 'style_weight'], ['style']),
+        helper.make_node('Unsqueeze', ['style', 'style_axes'], ['style_map']),
+        helper.make_node('Add', ['conv3', 'style_map'], ['styled']),
+        helper.make_node('Sigmoid', ['styled'], ['output'])
+    ]
+    initializers.append(numpy_helper.from_array((numpy.random.standard_normal((512, 3)) * 0.01).astype(numpy.float32), 'style_weight'))
+    initializers.append(numpy_helper.from_array(numpy.array([2, 3], dtype=numpy.int64), 'style_axes'))
+    initializers.append(numpy_helper.from_array(numpy.eye(512, dtype=numpy.float32), 'emap'))
+    inputs = [helper.make_tensor_value_info('target', TensorProto.FLOAT, ['batch', 3, SWAPPER_SIZE, SWAPPER_SIZE]), helper.make_tensor_value_info('source', TensorProto.FLOAT, ['batch', 512])]
+    outputs = [helper.make_tensor_value_info('output', TensorProto.FLOAT, ['batch', 3, SWAPPER_SIZE, SWAPPER_SIZE])]
+    save_model(helper.make_graph(nodes, 'inswapper', inputs, outputs, initializers), model_path)
+
+
+def create_models(models_path: str) -> Dict[str, str]:
+    os.makedirs(models_path, exist_ok=True)
+    numpy.random.seed(0)
+    model_paths = {
+        'detector': os.path.join(models_path, 'detector.onnx'),
+        'recognizer': os.path.join(models_path, 'recognizer.onnx'),
+        'swapper': os.path.join(models_path, 'inswapper_128.onnx')
+    }
+    for name, create_model in [('detector', create_detector_model), ('recognizer', create_recognizer_model), ('swapper', create_swapper_model)]:
+        if not os.path.isfile(model_paths[name]):
+            create_model(model_paths[name])
+    return model_paths
+
+
+def create_frames(frames_path: str, resolution: Tuple[int, int], frame_total: int) -> List[str]:
+    os.makedirs(frames_path, exist_ok=True)
+    width, height = resolution
+    if shutil.which('ffmpeg'):
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate=30', '-frames:v', str(frame_total), '-pix_fmt', 'rgb24', '-y', os.path.join(frames_path, '%04d.png')], check=True)
+    else:
+        gradient = numpy.linspace(0, 255, width, dtype=numpy.float32)[None, :, None]
+        for frame_number in range(frame_total):
+            frame = numpy.broadcast_to((gradient + frame_number * 8) % 256, (height, width, 3)).astype(numpy.uint8, order='C')
+            cv2.putText(frame, str(frame_number), (width // 8, height // 2), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+            cv2.imwrite(os.path.join(frames_path, f'{frame_number + 1:04d}.png'), frame)
+    return sorted(os.path.join(frames_path, file_name) for file_name in os.listdir(frames_path))
+
+
+def get_face_boxes(resolution: Tuple[int, int], face_total: int) -> List[Tuple[float, float, float]]:
+    width, height = resolution
+    columns = int(numpy.ceil(numpy.sqrt(face_total)))
+    rows = int(numpy.ceil(face_total / columns))
+    face_size = min(width / columns, height / rows) * 0.6
+    return [((column + 0.5) * width / columns - face_size / 2, (row + 0.5) * height / rows - face_size / 2, face_size) for row in range(rows) for column in range(columns)][:face_total]
+
+
+def create_face_analyser(model_paths: Dict[str, str], face_total: int, with_recognition: bool) -> Any:
+    import onnxruntime
+    from insightface.utils import face_align
+    from roop.face_analyser import create_face
+
+    detector = onnxruntime.InferenceSession(model_paths['detector'], providers=['CPUExecutionProvider'])
+    recognizer = onnxruntime.InferenceSession(model_paths['recognizer'], providers=['CPUExecutionProvider'])
+
+    def get(frame: Any) -> List[Any]:
+        detector.run(None, {'input': cv2.dnn.blobFromImage(frame, 1.0 / 128, (DETECTOR_SIZE, DETECTOR_SIZE), (127.5, 127.5, 127.5), swapRB=True)})
+        faces = []
+        for start_x, start_y, face_size in get_face_boxes((frame.shape[1], frame.shape[0]), face_total):
+            kps = FACE_TEMPLATE * face_size / RECOGNIZER_SIZE + (start_x, start_y)
+            face = create_face(bbox=numpy.array([start_x, start_y, start_x + face_size, start_y + face_size], dtype=numpy.float32), kps=kps.astype(numpy.float32), det_score=0.9)
+            if with_recognition:
+                crop_frame = face_align.norm_crop(frame, kps, RECOGNIZER_SIZE)
+                face.embedding = recognizer.run(None, {'input': cv2.dnn.blobFromImage(crop_frame, 1.0 / 127.5, (RECOGNIZER_SIZE, RECOGNIZER_SIZE), (127.5, 127.5, 127.5), swapRB=True)})[0][0]
+            faces.append(face)
+        return faces
+
+    return SimpleNamespace(get=get)
+
+
+def create_source_face() -> Any:
+    from roop.face_analyser import create_face
+
+    source_face = create_face(bbox=numpy.array([0, 0, 112, 112], dtype=numpy.float32), kps=FACE_TEMPLATE.copy(), det_score=0.9)
+    source_face.embedding = numpy.random.RandomState(1).standard_normal(512).astype(numpy.float32)
+    return source_face
+
+
+def create_enhancer(device: Optional[str] = None) -> Any:
+    import torch
+
+    network = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 16, 3, padding=1),
+        torch.nn.ReLU(),
+        torch.nn.Conv2d(16, 16, 3, stride=2, padding=1),
+        torch.nn.ReLU(),
+        torch.nn.Upsample(scale_factor=2),
+        torch.nn.Conv2d(16, 3, 3, padding=1),
+        torch.nn.Tanh()
+    ).eval()
+
+    def run_gfpgan(cropped_faces_t: Any, return_rgb: bool = False, weight: float = 0.5) -> Tuple[Any, None]:
+        return network(cropped_faces_t), None
+
+    return SimpleNamespace(gfpgan=run_gfpgan, device=torch.device(device or 'cpu'))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from typing import Any, Dict, List, Tuple
+
+import numpy
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT_PATH)
+
+from standins import create_enhancer, create_face_analyser, create_frames, create_models, create_source_face # noqa: E402
+
+
+def decode_resolution(resolution: str) -> Tuple[int, int]:
+    width, _, height = resolution.partition('x')
+    return int(width), int(height)
+
+
+def get_media_path(work_path: str, resolution: str) -> str:
+    return os.path.join(work_path, 'media', resolution)
+
+
+def get_frame_latencies(profile_events: List[Dict[str, Any]]) -> List[float]:
+    frame_spans: Dict[int, Tuple[float, float]] = {}
+    for event in profile_events:
+        frame_index = event['args'].get('frame')
+        if event['cat'] == 'stage' and frame_index is not None:
+            start_time, end_time = frame_spans.get(frame_index, (event['ts'], event['ts']))
+            frame_spans[frame_index] = (min(start_time, event['ts']), max(end_time, event['ts'] + event['dur']))
+    return [(end_time - start_time) / 1000 for start_time, end_time in frame_spans.values()]
+
+
+def get_peak_memory() -> int:
+    try:
+        import resource
+
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_memory if sys.platform == 'darwin' else peak_memory * 1024
+    except ImportError:
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset
+
+
+def create_face_swapper(model_path: str) -> Any:
+    from insightface.model_zoo.inswapper import INSwapper
+    from roop.utilities import create_inference_session
+
+    return INSwapper(model_file=model_path, session=create_inference_session(model_path))
+
+
+def load_models(configuration: Dict[str, Any], model_paths: Dict[str, str]) -> None:
+    from roop.model_registry import get_model
+
+    for profile in ['detection', 'recognition', 'full']:
+        get_model(f'face_analyser.{profile}', partial(create_face_analyser, model_paths, configuration['faces'], profile != 'detection'))
+    get_model('face_swapper', partial(create_face_swapper, model_paths['swapper']))
+    if 'face_enhancer' in configuration['processors']:
+        for index in range(configuration['threads']):
+            get_model(f'gfpgan.{index}', create_enhancer)
+
+
+def run_configuration(configuration: Dict[str, Any], work_path: str) -> Dict[str, Any]:
+    import roop.globals
+
+    roop.globals.headless = True
+    roop.globals.execution_providers = ['CPUExecutionProvider']
+    roop.globals.execution_threads = configuration['threads']
+    roop.globals.model_instances = configuration['threads']
+    roop.globals.many_faces = True
+    roop.globals.face_analysis_profile = configuration['profile']
+    roop.globals.frame_processors = configuration['processors']
+    roop.globals.selected_enhancer = 'GFPGAN' if 'face_enhancer' in configuration['processors'] else None
+    roop.globals.profile_path = os.path.join(work_path, 'profile.json')
+
+    from roop.processors.frame.core import get_frame_processors_modules, get_pipeline_stages, process_video
+    from roop.profiler import PROFILE_EVENTS
+
+    load_models(configuration, create_models(os.path.join(work_path, 'models')))
+    frames_path = os.path.join(work_path, 'frames')
+    shutil.copytree(get_media_path(work_path, configuration['resolution']), frames_path)
+    frame_paths = sorted(os.path.join(frames_path, file_name) for file_name in os.listdir(frames_path))
+    frame_processors = get_frame_processors_modules(configuration['processors'])
+    for frame_processor in frame_processors:
+        for _, warm_up in frame_processor.get_warm_up_tasks():
+            warm_up()
+    PROFILE_EVENTS.clear()
+    start_time = time.perf_counter()
+    process_video(create_source_face(), None, frame_paths, get_pipeline_stages(frame_processors))
+    elapsed = time.perf_counter() - start_time
+    latencies = get_frame_latencies(PROFILE_EVENTS)
+    return {
+        'configuration': configuration,
+        'frames': len(frame_paths),
+        'fps': len(frame_paths) / elapsed,
+        'p50_ms': float(numpy.percentile(latencies, 50)),
+        'p99_ms': float(numpy.percentile(latencies, 99)),
+        'peak_rss_mb': get_peak_memory() / 1024 / 1024
+    }
+
+
+def run_worker(configuration: Dict[str, Any], work_path: str) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(dir=work_path) as run_path:
+        os.symlink(os.path.join(work_path, 'media'), os.path.join(run_path, 'media'))
+        os.symlink(os.path.join(work_path, 'models'), os.path.join(run_path, 'models'))
+        completed = subprocess.run([sys.executable, __file__, '--worker', json.dumps(configuration), '--work-path', run_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if completed.returncode != 0 or not completed.stdout.strip():
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f'exit code {completed.returncode}')
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def has_enhancer_standin() -> bool:
+    try:
+        import torch # noqa: F401
+        import enhancer.GFPGAN # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def format_configuration(configuration: Dict[str, Any]) -> str:
+    return f'{"+".join(configuration["processors"])} {configuration["resolution"]} threads={configuration["threads"]} faces={configuration["faces"]}'
+
+
+def main() -> None:
+    program = argparse.ArgumentParser(description='measure the frame throughput of roop with synthetic media and stand-in models')
+    program.add_argument('--frames', help='frames per synthetic video', dest='frames', type=int, default=60)
+    program.add_argument('--threads', help='execution threads to compare', dest='threads', type=int, default=[1, 4], nargs='+')
+    program.add_argument('--processors', help='comma separated frame processors to compare', dest='processors', default=['face_swapper', 'face_swapper,face_enhancer'], nargs='+')
+    program.add_argument('--resolutions', help='frame resolutions to compare', dest='resolutions', default=['640x360', '1280x720'], nargs='+')
+    program.add_argument('--faces', help='faces per frame to compare', dest='faces', type=int, default=[1, 4], nargs='+')
+    program.add_argument('--face-analysis-profile', help='face analysis models to run on frames', dest='profile', default='auto', choices=['auto', 'detection', 'recognition', 'full'])
+    program.add_argument('--output', help='write the results to a json file', dest='output_path')
+    program.add_argument('--worker', help=argparse.SUPPRESS, dest='worker')
+    program.add_argument('--work-path', help=argparse.SUPPRESS, dest='work_path')
+    args = program.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_configuration(json.loads(args.worker), args.work_path)))
+        return
+
+    processors = [processor.split(',') for processor in args.processors]
+    if not has_enhancer_standin():
+        print('torch or gfpgan is not installed, skipping face_enhancer configurations')
+        processors = [processor for processor in processors if 'face_enhancer' not in processor]
+    results = []
+    with tempfile.TemporaryDirectory() as work_path:
+        create_models(os.path.join(work_path, 'models'))
+        for resolution in args.resolutions:
+            create_frames(get_media_path(work_path, resolution), decode_resolution(resolution), args.frames)
+        print(f'{"configuration":<56} {"fps":>8} {"p50 ms":>10} {"p99 ms":>10} {"peak rss mb":>12}')
+        for processor, resolution, threads, faces in itertools.product(processors, args.resolutions, args.threads, args.faces):
+            configuration = {'processors': processor, 'resolution': resolution, 'threads': threads, 'faces': faces, 'profile': args.profile}
+            try:
+                result = run_worker(configuration, work_path)
+            except RuntimeError as exception:
+                print(f'{format_configuration(configuration):<56} failed: {exception}')
+                continue
+            results.append(result)
+            print(f'{format_configuration(configuration):<56} {result["fps"]:>8.1f} {result["p50_ms"]:>10.1f} {result["p99_ms"]:>10.1f} {result["peak_rss_mb"]:>12.0f}')
+    if args.output_path:
+        with open(args.output_path, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,103 +1,86 @@
 from operator import eq
+from typing import Any, List, Tuple
 import cv2
 import torch
 import threading
 from tqdm import tqdm
 from torchvision.transforms.functional import normalize
-from codeformer.facelib.utils.face_restoration_helper import FaceRestoreHelper
+from codeformer.facelib.parsing import init_parsing_model
 from codeformer.basicsr.utils.registry import ARCH_REGISTRY
 from codeformer.basicsr.utils import img2tensor, tensor2img
 
+import numpy
+import roop.globals
+
+from roop.model_registry import use_model_instance
+from roop.typing import Frame
 from roop.utilities import resolve_relative_path, get_device
 
+PARSE_MASK_COLORMAP = numpy.array([0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 0, 0, 0], dtype=numpy.float32)
+
 # if 'ROCMExecutionProvider' in roop.globals.execution_providers:
     # del torch
 
-CODE_FORMER = None
-FACE_HELPER = None
-
 
-def create():
-    global CODE_FORMER, FACE_HELPER
-    
+def create() -> Tuple[Any, Any]:
     model_path = resolve_relative_path('../models/codeformer.pth')
     model = torch.load(model_path)['params_ema']
     device = torch.device(get_device())
-    CODE_FORMER = ARCH_REGISTRY.get('CodeFormer')(
+    code_former = ARCH_REGISTRY.get('CodeFormer')(
         dim_embd=512,
         codebook_size=1024,
         n_head=8,
         n_layers=9,
         connect_list=['32', '64', '128', '256'],
     ).to(device)
-    CODE_FORMER.load_state_dict(model)
-    CODE_FORMER.eval()
-    
-    FACE_HELPER = FaceRestoreHelper(
-            upscale_factor = int(2),
-            face_size=512,
-            crop_ratio=(1, 1),
-            det_model="retinaface_resnet50",
-            save_ext="png",
-            use_parse=True,
-            device=get_device()
-        )
-
-
-def enhance_Codeformer(temp_frame):
-    global CODE_FORMER
-
-    if CODE_FORMER == None:
-        create()
-
-    FACE_HELPER.clean_all()
-
-    try:
-        FACE_HELPER.read_image(temp_frame)
-        # get face landmarks for each face
-        FACE_HELPER.get_face_landmarks_5(only_center_face=False, resize=640, eye_dist_threshold=5)
-        # align and warp each face
-        FACE_HELPER.align_warp_face()
-        for idx, cropped_face in enumerate(FACE_HELPER.cropped_faces):
-            face_t = data_preprocess(cropped_face)
-            face_enhanced = restore_face(face_t)
-            FACE_HELPER.add_restored_face(face_enhanced)
-
-        FACE_HELPER.get_inverse_affine()
-        enhanced_img = FACE_HELPER.paste_faces_to_input_image()
-        h, w, _ = temp_frame.shape
-        #if h != enhanced_img.shape.h or w != enhanced_img.shape.w:
-        enhanced_img = cv2.resize(enhanced_img, (w, h), interpolation=cv2.INTER_LINEAR)
-
-        return enhanced_img
-
-    except RuntimeError as error:
-        print(f"Failed inference for CodeFormer: {error}")
-
-
-def data_preprocess(frame):
+    code_former.load_state_dict(model)
+    code_former.eval()
+    face_parse = init_parsing_model(model_name='parsenet', device=device) if roop.globals.enhancer_mask == 'parse' else None
+    return code_former, face_parse
+
+
+def restore_crops_Codeformer(cropped_faces: List[Frame]) -> List[Frame]:
+    with use_model_instance('codeformer', create) as (code_former, _):
+        faces_t = torch.cat([data_preprocess(cropped_face) for cropped_face in cropped_faces])
+        try:
+            outputs = generate_output(code_former, faces_t)
+            return [postprocess_output(output) for output in outputs]
+        except RuntimeError as error:
+            print(f"Failed inference for CodeFormer: {error}")
+            return cropped_faces
+
+
+def parse_Codeformer(restored_faces: List[Frame]) -> List[Frame]:
+    with use_model_instance('codeformer', create) as (_, face_parse):
+        faces_t = torch.cat([data_preprocess(cv2.resize(restored_face, (512, 512), interpolation=cv2.INTER_LINEAR)) for restored_face in restored_faces])
+        with torch.no_grad():
+            parsing = face_parse(faces_t)[0].argmax(dim=1).cpu().numpy()
+    return [create_parse_mask(parse, restored_face.shape[:2]) for parse, restored_face in zip(parsing, restored_faces)]
+
+
+def create_parse_mask(parse: Any, face_shape: Tuple[int, ...]) -> Frame:
+    parse_mask = PARSE_MASK_COLORMAP[parse]
+    parse_mask = cv2.GaussianBlur(parse_mask, (101, 101), 11)
+    parse_mask = cv2.GaussianBlur(parse_mask, (101, 101), 11)
+    parse_mask[:10, :] = 0
+    parse_mask[-10:, :] = 0
+    parse_mask[:, :10] = 0
+    parse_mask[:, -10:] = 0
+    return cv2.resize(parse_mask, (face_shape[1], face_shape[0]))
+
+
+def data_preprocess(frame: Frame) -> Any:
     frame_t = img2tensor(frame / 255.0, bgr2rgb=True, float32=True)
     normalize(frame_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
     return frame_t.unsqueeze(0).to(get_device())
 
 
-def generate_output(frame_t, codeformer_fidelity = 0.6):
+def generate_output(code_former: Any, frame_t: Any, codeformer_fidelity: float = 0.6) -> Any:
     with torch.no_grad():
-        output = CODE_FORMER(frame_t, w=codeformer_fidelity, adain=True)[0]
+        output = code_former(frame_t, w=codeformer_fidelity, adain=True)[0]
     return output
 
 
-def restore_face(face_t):
-    try:
-        output = generate_output(face_t)
-        restored_face = postprocess_output(output)
-        del output
-    except RuntimeError as error:
-        print(f"Failed inference for CodeFormer: {error}")
-        restored_face = postprocess_output(face_t)
-    return restored_face
-
-
-def postprocess_output(output):
+def postprocess_output(output: Any) -> Frame:
     restored_face = tensor2img(output, rgb2bgr=True, min_max=(-1, 1))
     return restored_face.astype("uint8")
\ No newline at end of file
@@ -21,15 +21,21 @@ import math
 import cv2 
 import os.path as osp
 import time
-#import face_alignment # pip install face-alignment or conda install -c 1adrianb face_alignment
 import os
 import math
 from torchvision.transforms.functional import normalize
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import face_alignment
+from roop.model_registry import get_model, use_model_instance
+from roop.typing import Frame
 from roop.utilities import resolve_relative_path, get_device
 
-oDMDNet = None
-FaceDetection = None
-device = None
+SPECIFIC_DICTIONARIES: Dict[Any, Any] = {}
+SPECIFIC_DICTIONARIES_SIZE = 16
+ALIGNED_FACE_BOX = [96, 128, 416, 480]
+THREAD_LOCK = threading.Lock()
 
 
 def calc_mean_std_4D(feat, eps=1e-5):
@@ -640,104 +646,114 @@ class UpResBlock(nn.Module):
 # Interface to roop
 #######################################
 
-def create():
-    global device, oDMDNet
-
-    device = torch.device(get_device())
-    oDMDNet = DMDNet().to(device)
-    directory = os.getcwd()
-    weights = torch.load('./models/DMDNet.pth') 
-    oDMDNet.load_state_dict(weights, strict=True)
+def create() -> Any:
+    model = DMDNet().to(torch.device(get_device()))
+    weights = torch.load(resolve_relative_path('../models/DMDNet.pth'))
+    model.load_state_dict(weights, strict=True)
 
-    oDMDNet.eval()
+    model.eval()
     num_params = 0
-    for param in oDMDNet.parameters():
+    for param in model.parameters():
         num_params += param.numel()
 
-    print('{:>8s} : {}'.format('Using device', device))
+    print('{:>8s} : {}'.format('Using device', get_device()))
     print('{:>8s} : {:.2f}M'.format('Model params', num_params/1e6))
-
-
-def enhance_DMDNet(temp_frame):
-    global device, oDMDNet, FaceDetection
-
-    if oDMDNet == None:
-        create()
-    FaceDetection = face_alignment.FaceAlignment(face_alignment.LandmarksType.TWO_D, device=get_device())
-
-    lq, lq_landmarks = read_img_tensor(temp_frame, return_landmark=True)
-    if lq_landmarks is None:
-        print('Error detecting landmarks')
-        return None
-
-    LQLocs = get_component_location(lq_landmarks)
-
-    # generic
-    SpMem256Para, SpMem128Para, SpMem64Para = None, None, None
-
-    with torch.no_grad():
-        try:
-            GenericResult, SpecificResult = oDMDNet(lq = lq.to(device), loc = LQLocs.unsqueeze(0), sp_256 = SpMem256Para, sp_128 = SpMem128Para, sp_64 = SpMem64Para)
-        except Exception as e:
-            print(f'Error {e} there may be something wrong with the detected component locations.')
-            return None
-    save_generic = GenericResult * 0.5 + 0.5
-    save_generic = save_generic.squeeze(0).permute(1, 2, 0).flip(2) # RGB->BGR
-    save_generic = np.clip(save_generic.float().cpu().numpy(), 0, 1) * 255.0
-
-    check_lq = lq * 0.5 + 0.5
-    check_lq = check_lq.squeeze(0).permute(1, 2, 0).flip(2) # RGB->BGR
-    check_lq = np.clip(check_lq.float().cpu().numpy(), 0, 1) * 255.0
-    enhanced_img =  np.hstack((check_lq, save_generic))
-    return save_generic
-
-
-def read_img_tensor(Img=None, return_landmark=True): #rgb -1~1 
-#    Img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)  # BGR or G
+    return model
+
+
+def create_face_alignment() -> Any:
+    return face_alignment.FaceAlignment(face_alignment.LandmarksType.TWO_D, device=get_device())
+
+
+def get_face_alignment() -> Any:
+    return get_model('face_alignment', create_face_alignment)
+
+
+def get_specific_dictionary(dmdnet: Any, identity: Any, source_crop: Frame) -> Any:
+    with THREAD_LOCK:
+        if identity not in SPECIFIC_DICTIONARIES:
+            sp_img, sp_landmarks = read_img_tensor(source_crop)
+            while len(SPECIFIC_DICTIONARIES) >= SPECIFIC_DICTIONARIES_SIZE:
+                del SPECIFIC_DICTIONARIES[next(iter(SPECIFIC_DICTIONARIES))]
+            if sp_landmarks is None:
+                SPECIFIC_DICTIONARIES[identity] = None
+            else:
+                sp_locs = get_component_location(sp_landmarks).unsqueeze(0).to(get_device())
+                with torch.no_grad():
+                    SPECIFIC_DICTIONARIES[identity] = dmdnet.generate_specific_dictionary(sp_imgs=sp_img.to(get_device()), sp_locs=sp_locs)
+        return SPECIFIC_DICTIONARIES[identity]
+
+
+def clear_specific_dictionaries() -> None:
+    with THREAD_LOCK:
+        SPECIFIC_DICTIONARIES.clear()
+
+
+def restore_crops_DMDNet(cropped_faces: List[Frame], source_crops: List[Optional[Tuple[Any, Frame]]]) -> List[Frame]:
+    restored_faces: List[Frame] = []
+    with use_model_instance('dmdnet', create) as dmdnet:
+        for cropped_face, source_crop in zip(cropped_faces, source_crops):
+            lq, lq_landmarks = read_img_tensor(cropped_face)
+            if lq_landmarks is None:
+                restored_faces.append(cropped_face)
+                continue
+            lq_locs = get_component_location(lq_landmarks).unsqueeze(0).to(get_device())
+            specific_dictionary = get_specific_dictionary(dmdnet, *source_crop) if source_crop else None
+            try:
+                with torch.no_grad():
+                    fs_in = dmdnet.E_lq(lq.to(get_device()), lq_locs)
+                    if specific_dictionary is None:
+                        memstar = dmdnet.enhancer(fs_in)[:3]
+                    else:
+                        memstar = dmdnet.enhancer(fs_in, *specific_dictionary)[:3]
+                    output = dmdnet.reconstruct(fs_in, lq_locs, memstar=list(memstar))
+            except Exception as e:
+                print(f'Error {e} there may be something wrong with the detected component locations.')
+                restored_faces.append(cropped_face)
+                continue
+            restored_face = output * 0.5 + 0.5
+            restored_face = restored_face.squeeze(0).permute(1, 2, 0).flip(2) # RGB->BGR
+            restored_faces.append((np.clip(restored_face.float().cpu().numpy(), 0, 1) * 255.0).astype(np.uint8))
+    return restored_faces
+
+
+def read_img_tensor(Img: Frame, return_landmark: bool = True) -> Tuple[Any, Any]: #rgb -1~1
     if Img.ndim == 2:
         Img = cv2.cvtColor(Img, cv2.COLOR_GRAY2RGB)  # GGG
     else:
         Img = cv2.cvtColor(Img, cv2.COLOR_BGR2RGB)  # RGB
-    
+
     if Img.shape[0] < 512 or Img.shape[1] < 512:
         Img = cv2.resize(Img, (512,512), interpolation = cv2.INTER_AREA)
 
     ImgForLands = Img.copy()
-    Img = Img.transpose((2, 0, 1))/255.0
-    Img = torch.from_numpy(Img).float()
-    normalize(Img, [0.5,0.5,0.5], [0.5,0.5,0.5], inplace=True)
-    ImgTensor = Img.unsqueeze(0)
+    ImgTensor = torch.from_numpy(Img.transpose((2, 0, 1))/255.0).float()
+    normalize(ImgTensor, [0.5,0.5,0.5], [0.5,0.5,0.5], inplace=True)
+    ImgTensor = ImgTensor.unsqueeze(0)
     SelectPred = None
     PredsAll = None
     if return_landmark:
         try:
-            PredsAll = FaceDetection.get_landmarks(ImgForLands)
+            # aligned crops have the face at a known place, so the landmark model skips its own detector
+            PredsAll = get_face_alignment().get_landmarks(ImgForLands, detected_faces=[ALIGNED_FACE_BOX])
         except Exception as e:
             print(f'Error {e} in detecting face.')
 
         if PredsAll is None:
             print('Warning: No face is detected.')
             return ImgTensor, None
-        ins = 0
-        if len(PredsAll)!=1:
-            hights = []
-            for l in PredsAll:
-                hights.append(l[8,1] - l[19,1])
-            ins = hights.index(max(hights))
-            print('Warning: Too many faces are detected, only handle the largest one...')
-        SelectPred = PredsAll[ins]
+        SelectPred = PredsAll[0]
     return ImgTensor, SelectPred
 
 
-def get_component_location(Landmarks, re_read=False):
+def get_component_location(Landmarks: Any, re_read: bool = False) -> Any:
     if re_read:
         ReadLandmark = []
         with open(Landmarks,'r') as f:
             for line in f:
                 tmp = [float(i) for i in line.split(' ') if i != '\n']
                 ReadLandmark.append(tmp)
-        ReadLandmark = np.array(ReadLandmark) #
-        Landmarks = np.reshape(ReadLandmark, [-1, 2]) # 68*2
+        Landmarks = np.reshape(np.array(ReadLandmark), [-1, 2]) # 68*2
     Map_LE_B = list(np.hstack((range(17,22), range(36,42))))
     Map_RE_B = list(np.hstack((range(22,27), range(42,48))))
     Map_LE = list(range(36,42))
@@ -1,28 +1,34 @@
+from typing import Any, List
+
 import gfpgan
+import torch
 import roop.globals
 
+from basicsr.utils import img2tensor, tensor2img
+from torchvision.transforms.functional import normalize
+from roop.model_registry import use_model_instance
+from roop.typing import Frame
 from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video
 
-myself = None
-
-
-def create():
-    global myself
 
+def create() -> Any:
     model_path = resolve_relative_path('../models/GFPGANv1.4.pth')
-    myself = gfpgan.GFPGANer(model_path=model_path, upscale=1) # type: ignore[attr-defined]
-
-
-def enhance_GFPGAN(temp_frame):
-    global myself
+    return gfpgan.GFPGANer(model_path=model_path, upscale=1) # type: ignore[attr-defined]
 
-    if myself == None:
-        create()
 
-    _, _, temp_frame = myself.enhance(
-            temp_frame,
-            paste_back=True
-        )
-    return temp_frame
+def restore_crops_GFPGAN(cropped_faces: List[Frame]) -> List[Frame]:
+    with use_model_instance('gfpgan', create) as gfpganer:
+        cropped_faces_t = torch.stack([preprocess_crop(cropped_face) for cropped_face in cropped_faces]).to(gfpganer.device)
+        try:
+            with torch.no_grad():
+                outputs = gfpganer.gfpgan(cropped_faces_t, return_rgb=False, weight=0.5)[0]
+            return [tensor2img(output, rgb2bgr=True, min_max=(-1, 1)).astype('uint8') for output in outputs]
+        except RuntimeError as error:
+            print(f'Failed inference for GFPGAN: {error}')
+            return cropped_faces
 
 
+def preprocess_crop(cropped_face: Frame) -> Any:
+    cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
+    normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+    return cropped_face_t
@@ -0,0 +1,59 @@
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+Batcher = Dict[str, Any]
+
+
+def create_batcher(run_batch: Callable[[List[Any]], List[Any]], batch_size: int, max_wait: float = 0.005, workers: int = 1) -> Batcher:
+    queue: Queue[Optional[Tuple[Any, Future[Any]]]] = Queue()
+
+    def run_items(batch: List[Tuple[Any, Future[Any]]]) -> None:
+        try:
+            results = run_batch([item for item, _ in batch])
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+        except Exception as exception:
+            for _, future in batch:
+                future.set_exception(exception)
+
+    def run_batches() -> None:
+        while True:
+            entry = queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            deadline = time.monotonic() + max_wait
+            while len(batch) < batch_size:
+                try:
+                    entry = queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except Empty:
+                    break
+                if entry is None:
+                    run_items(batch)
+                    return
+                batch.append(entry)
+            run_items(batch)
+
+    threads = [threading.Thread(target=run_batches, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return {'queue': queue, 'threads': threads, 'closed': False}
+
+
+def submit_batch_item(batcher: Batcher, item: Any) -> 'Future[Any]':
+    if batcher['closed']:
+        raise RuntimeError('Batcher is closed.')
+    future: Future[Any] = Future()
+    batcher['queue'].put((item, future))
+    return future
+
+
+def close_batcher(batcher: Batcher) -> None:
+    batcher['closed'] = True
+    for _ in batcher['threads']:
+        batcher['queue'].put(None)
+    for thread in batcher['threads']:
+        thread.join()
@@ -8,24 +8,25 @@ if any(arg.startswith('--execution-provider') for arg in sys.argv):
 # reduce tensorflow log level
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import warnings
-from typing import List
+import json
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import platform
 import signal
 import shutil
 import argparse
-import torch
-import onnxruntime
-#import tensorflow
+import threading
+from types import ModuleType
 
 import roop.globals
 import roop.metadata
-import roop.ui as ui
-from roop.processors.frame.core import get_frame_processors_modules
-from roop.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path, has_extension
+from roop.processors.frame.core import get_frame_processors_modules, get_pipeline_stages, process_video, process_batch, process_video_stream, process_image_chain
+from roop.processors.frame.multiprocess import release_process_pool
+from roop.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path, has_extension, get_destfilename_from_path
 from roop.face_analyser import extract_face_images
+from roop.profiler import save_profile
+from roop.job_manifest import load_manifest, create_manifest, save_manifest, remove_manifest, is_resumable, activate_manifest, get_active_manifest, get_resume_index, save_active_manifest
 
-if 'ROCMExecutionProvider' in roop.globals.execution_providers:
-    del torch
+PIPELINE_STAGES = ['decode', 'detect', 'swap', 'enhance', 'encode', 'process']
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='insightface')
 warnings.filterwarnings('ignore', category=UserWarning, module='torchvision')
@@ -41,15 +42,30 @@ def parse_args() -> None:
     program.add_argument('--frame-processor', help='frame processors (choices: face_swapper, face_enhancer, ...)', dest='frame_processor', default=['face_swapper'], nargs='+')
     program.add_argument('--keep-fps', help='keep target fps', dest='keep_fps', action='store_true')
     program.add_argument('--keep-frames', help='keep temporary frames', dest='keep_frames', action='store_true')
+    program.add_argument('--resume', help='keep the temporary frames of interrupted video jobs and resume them', dest='resume', action='store_true')
+    program.add_argument('--skip-duplicate-frames', help='reuse the result of near-identical and face-free video frames', dest='skip_duplicate_frames', action='store_true')
+    program.add_argument('--stream-video', help='stream frames through ffmpeg pipes instead of temporary frames', dest='stream_video', action='store_true')
     program.add_argument('--skip-audio', help='skip target audio', dest='skip_audio', action='store_true')
+    program.add_argument('--enhancer-blend', help='blend ratio of enhanced faces into the frame', dest='enhancer_blend', type=float, default=0.5)
+    program.add_argument('--enhancer-batch-size', help='number of faces restored in one enhancer inference, across frames', dest='enhancer_batch_size', type=int, default=1)
+    program.add_argument('--enhancer-mask', help='mask used to blend CodeFormer faces into the frame', dest='enhancer_mask', default='ellipse', choices=['ellipse', 'parse'])
     program.add_argument('--many-faces', help='process every face', dest='many_faces', action='store_true')
-    program.add_argument('--source-face_index', help='index position of source face in image', dest='source_face_index', type=int, default=0)
-    program.add_argument('--target-face_index', help='index position of target face in image', dest='target_face_index', type=int, default=0)
+    program.add_argument('--face-analysis-profile', help='face analysis models to run on frames', dest='face_analysis_profile', default='auto', choices=['auto', 'detection', 'recognition', 'full'])
+    program.add_argument('--face-detection-size', help='face detector input size', dest='face_detection_size', type=int, default=640)
+    program.add_argument('--face-cache', help='store face detections of a target video next to it and reuse them on later runs', dest='face_cache', action='store_true')
+    program.add_argument('--face-detection-interval', help='run full face detection every n frames and track faces in between', dest='face_detection_interval', type=int, default=1)
+    program.add_argument('--face-map', help='source face to swap onto each target face, as index pairs or a json file', dest='face_map', type=decode_face_mapping, default=[[(0, 0)]], nargs='+', metavar='SOURCE=TARGET')
     program.add_argument('--video-encoder', help='adjust output video encoder', dest='video_encoder', default='libx264', choices=['libx264', 'libx265', 'libvpx-vp9'])
     program.add_argument('--video-quality', help='adjust output video quality', dest='video_quality', type=int, default=18, choices=range(52), metavar='[0-51]')
     program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int, default=suggest_max_memory())
+    program.add_argument('--profile', help='record stage timings into a chrome trace json and print a summary', dest='profile_path')
+    program.add_argument('--model-instances', help='maximum instances of each enhancer model for parallel threads (default: as many as threads and free memory allow)', dest='model_instances', type=int)
+    program.add_argument('--model-memory-budget', help='maximum amount of memory in GB for loaded models, least recently used models get unloaded beyond it', dest='model_memory_budget', type=float)
     program.add_argument('--execution-provider', help='available execution provider (choices: cpu, ...)', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
     program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int, default=suggest_execution_threads())
+    program.add_argument('--execution-backend', help='run frame processors in threads or in worker processes sharing frames through shared memory', dest='execution_backend', default='thread', choices=['thread', 'process'])
+    program.add_argument('--swap-batch-size', help='number of faces swapped in one inswapper run across faces and frames', dest='swap_batch_size', type=int, default=1)
+    program.add_argument('--pipeline-workers', help='number of workers per pipeline stage (stages: decode, detect, swap, enhance, encode)', dest='pipeline_workers', type=decode_pipeline_worker, default=[], nargs='+', metavar='STAGE=WORKERS')
     program.add_argument('-v', '--version', action='version', version=f'{roop.metadata.name} {roop.metadata.version}')
 
     args = program.parse_args()
@@ -64,18 +80,35 @@ def parse_args() -> None:
         roop.globals.frame_processors = ['face_swapper', 'face_enhancer']
     else:
         roop.globals.frame_processors = args.frame_processor
+        if 'face_enhancer' in roop.globals.frame_processors:
+            roop.globals.selected_enhancer = 'GFPGAN'
 
     roop.globals.keep_fps = args.keep_fps
     roop.globals.keep_frames = args.keep_frames
+    roop.globals.resume = args.resume
+    roop.globals.frame_filter = args.skip_duplicate_frames
+    roop.globals.stream_video = args.stream_video
     roop.globals.skip_audio = args.skip_audio
     roop.globals.many_faces = args.many_faces
-    roop.globals.source_face_index = args.source_face_index
-    roop.globals.target_face_index = args.target_face_index
+    roop.globals.enhancer_batch_size = max(args.enhancer_batch_size, 1)
+    roop.globals.enhancer_mask = args.enhancer_mask
+    roop.globals.profile_path = args.profile_path
+    roop.globals.enhancer_blend = min(max(args.enhancer_blend, 0.0), 1.0)
+    roop.globals.face_analysis_profile = args.face_analysis_profile
+    roop.globals.face_detection_size = args.face_detection_size
+    roop.globals.face_cache = args.face_cache
+    roop.globals.face_detection_interval = max(args.face_detection_interval, 1)
+    roop.globals.face_map = [face_pair for face_pairs in args.face_map for face_pair in face_pairs]
     roop.globals.video_encoder = args.video_encoder
     roop.globals.video_quality = args.video_quality
     roop.globals.max_memory = args.max_memory
+    roop.globals.model_memory_budget = args.model_memory_budget
+    roop.globals.model_instances = args.model_instances
     roop.globals.execution_providers = decode_execution_providers(args.execution_provider)
     roop.globals.execution_threads = args.execution_threads
+    roop.globals.execution_backend = args.execution_backend
+    roop.globals.pipeline_workers = dict(args.pipeline_workers)
+    roop.globals.swap_batch_size = max(args.swap_batch_size, 1)
 
 
 def encode_execution_providers(execution_providers: List[str]) -> List[str]:
@@ -83,10 +116,45 @@ def encode_execution_providers(execution_providers: List[str]) -> List[str]:
 
 
 def decode_execution_providers(execution_providers: List[str]) -> List[str]:
+    import onnxruntime
+
     return [provider for provider, encoded_execution_provider in zip(onnxruntime.get_available_providers(), encode_execution_providers(onnxruntime.get_available_providers()))
             if any(execution_provider in encoded_execution_provider for execution_provider in execution_providers)]
 
 
+def decode_pipeline_worker(pipeline_worker: str) -> Tuple[str, int]:
+    stage, _, workers = pipeline_worker.partition('=')
+    if stage not in PIPELINE_STAGES:
+        raise argparse.ArgumentTypeError(f'unknown stage {stage!r} (choose from {", ".join(PIPELINE_STAGES)})')
+    if not workers.isdigit() or int(workers) < 1:
+        raise argparse.ArgumentTypeError(f'invalid number of workers {workers!r} for stage {stage!r}')
+    return stage, int(workers)
+
+
+def decode_face_index(face_index: Any) -> int:
+    if isinstance(face_index, int) and not isinstance(face_index, bool) and face_index >= 0:
+        return face_index
+    if isinstance(face_index, str) and face_index.isdigit():
+        return int(face_index)
+    raise argparse.ArgumentTypeError(f'invalid face index {face_index!r} (expected an integer from 0)')
+
+
+def decode_face_mapping(face_mapping: str) -> List[Tuple[int, int]]:
+    if has_extension(face_mapping, ['json']):
+        try:
+            with open(face_mapping) as face_map_file:
+                mappings = json.load(face_map_file)
+        except (OSError, ValueError) as exception:
+            raise argparse.ArgumentTypeError(f'cannot read face map {face_mapping!r}: {exception}')
+        if not mappings or not isinstance(mappings, list) or not all(isinstance(mapping, dict) and 'source' in mapping and 'target' in mapping for mapping in mappings):
+            raise argparse.ArgumentTypeError(f'face map {face_mapping!r} must be a list of {{"source": SOURCE, "target": TARGET}} entries')
+        return [(decode_face_index(mapping['source']), decode_face_index(mapping['target'])) for mapping in mappings]
+    source_index, separator, target_index = face_mapping.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError(f'invalid face mapping {face_mapping!r} (expected SOURCE=TARGET)')
+    return [(decode_face_index(source_index), decode_face_index(target_index))]
+
+
 def suggest_max_memory() -> int:
     if platform.system().lower() == 'darwin':
         return 4
@@ -94,6 +162,8 @@ def suggest_max_memory() -> int:
 
 
 def suggest_execution_providers() -> List[str]:
+    import onnxruntime
+
     return encode_execution_providers(onnxruntime.get_available_providers())
 
 
@@ -127,7 +197,8 @@ def limit_resources() -> None:
 
 
 def release_resources() -> None:
-    if 'CUDAExecutionProvider' in roop.globals.execution_providers:
+    torch = sys.modules.get('torch')
+    if torch is not None and 'CUDAExecutionProvider' in roop.globals.execution_providers:
         torch.cuda.empty_cache()
 
 
@@ -144,18 +215,59 @@ def pre_check() -> bool:
 def update_status(message: str, scope: str = 'ROOP.CORE') -> None:
     print(f'[{scope}] {message}')
     if not roop.globals.headless:
+        import roop.ui as ui
+
         ui.update_status(message)
 
 
 
+def map_faces() -> None:
+    source_faces = [face for face, _ in extract_face_images(roop.globals.source_path, (False, 0), 'recognition')]
+    target_faces = []
+    if not roop.globals.many_faces and (is_image(roop.globals.target_path) or is_video(roop.globals.target_path)):
+        target_faces = [face for face, _ in extract_face_images(roop.globals.target_path, (is_video(roop.globals.target_path), 0), 'recognition')]
+    face_mappings = []
+    for source_index, target_index in roop.globals.face_map:
+        if source_index < len(source_faces) and target_index < len(target_faces):
+            face_mappings.append((source_faces[source_index], target_faces[target_index]))
+        elif not roop.globals.many_faces:
+            update_status(f'Ignoring face mapping {source_index}={target_index}, face not found.')
+    roop.globals.FACE_MAPPINGS = face_mappings
+    if face_mappings:
+        roop.globals.SELECTED_FACE_DATA_INPUT, roop.globals.SELECTED_FACE_DATA_OUTPUT = face_mappings[0]
+    elif source_faces:
+        source_index = roop.globals.face_map[0][0]
+        roop.globals.SELECTED_FACE_DATA_INPUT = source_faces[source_index] if source_index < len(source_faces) else source_faces[0]
+
+
+def warm_up_model(scope: str, name: str, warm_up: Callable[[], Any]) -> None:
+    try:
+        warm_up()
+    except Exception as exception:
+        update_status(f'Warm-up of {name} failed: {exception}', scope)
+
+
+def start_warm_up() -> None:
+    for frame_processor in get_enabled_frame_processors():
+        for name, warm_up in frame_processor.get_warm_up_tasks():
+            threading.Thread(target=warm_up_model, args=(frame_processor.NAME, name, warm_up), daemon=True).start()
+
+
+def report_execution_backend() -> None:
+    if roop.globals.execution_backend != 'process':
+        return
+    if roop.globals.face_detection_interval > 1:
+        update_status('Face tracking is not available with the process backend, detecting faces on every frame.')
+    if roop.globals.face_cache:
+        update_status('The face cache is not available with the process backend, ignoring --face-cache.')
+    if roop.globals.frame_filter:
+        update_status('Face-free frames are not learned with the process backend, only duplicate frames are skipped.')
+
+
 def start() -> None:
     if roop.globals.headless:
-        faces = extract_face_images(roop.globals.source_path,  (False, 0))
-        roop.globals.SELECTED_FACE_DATA_INPUT = faces[roop.globals.source_face_index]
-        faces = extract_face_images(roop.globals.target_path,  (False, has_image_extension(roop.globals.target_path)))
-        roop.globals.SELECTED_FACE_DATA_OUTPUT = faces[roop.globals.target_face_index]
-        if 'face_enhancer' in roop.globals.frame_processors:
-            roop.globals.selected_enhancer = 'GFPGAN'
+        map_faces()
+    report_execution_backend()
 
     if roop.globals.target_folder_path is not None:
         batch_process()
@@ -167,40 +279,33 @@ def start() -> None:
             return
 
     current_target = roop.globals.target_path
+    frame_processors = get_enabled_frame_processors()
 
     # process image to image
     if has_image_extension(current_target):
-        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
-            target = current_target
-            if frame_processor.NAME == 'ROOP.FACE-ENHANCER':
-                if roop.globals.selected_enhancer == None or roop.globals.selected_enhancer == 'None':
-                    continue
-                target = roop.globals.output_path
-
-            update_status(f'{frame_processor.NAME} in progress...')
-            frame_processor.process_image(roop.globals.SELECTED_FACE_DATA_INPUT, roop.globals.SELECTED_FACE_DATA_OUTPUT, target, roop.globals.output_path)
-            frame_processor.post_process()
-            release_resources()
+        update_status(f'{get_frame_processors_names(frame_processors)} in progress...')
+        process_image_chain(frame_processors, roop.globals.SELECTED_FACE_DATA_INPUT, roop.globals.SELECTED_FACE_DATA_OUTPUT, current_target, roop.globals.output_path)
+        post_process(frame_processors)
         if is_image(current_target):
             update_status('Processing to image succeed!')
         else:
             update_status('Processing to image failed!')
         return
 
-    update_status('Creating temp resources...')
-    create_temp(current_target)
-    update_status('Extracting frames...')
-    extract_frames(current_target)
-    temp_frame_paths = get_temp_frame_paths(current_target)
+    if roop.globals.stream_video:
+        stream_video(current_target, roop.globals.output_path)
+        if is_video(roop.globals.output_path):
+            update_status('Processing to video succeed!')
+        else:
+            update_status('Processing to video failed!')
+        return
 
-    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
-        if frame_processor.NAME == 'ROOP.FACE-ENHANCER' and roop.globals.selected_enhancer == 'None':
-            continue
+    manifest = prepare_video_job(current_target, frame_processors)
+    temp_frame_paths = get_temp_frame_paths(current_target)
 
-        update_status(f'{frame_processor.NAME} in progress...')
-        frame_processor.process_video(roop.globals.SELECTED_FACE_DATA_INPUT, roop.globals.SELECTED_FACE_DATA_OUTPUT, temp_frame_paths)
-        frame_processor.post_process()
-        release_resources()
+    update_status(f'{get_frame_processors_names(frame_processors)} in progress...')
+    process_video(roop.globals.SELECTED_FACE_DATA_INPUT, roop.globals.SELECTED_FACE_DATA_OUTPUT, temp_frame_paths, get_pipeline_stages(frame_processors), manifest, current_target)
+    post_process(frame_processors)
     # handles fps
     if roop.globals.keep_fps:
         update_status('Detecting fps...')
@@ -221,6 +326,7 @@ def start() -> None:
             update_status('Restoring audio might cause issues as fps are not kept...')
         restore_audio(current_target, roop.globals.output_path)
     # clean and validate
+    remove_manifest(current_target)
     clean_temp(current_target)
     if is_video(roop.globals.output_path):
         update_status('Processing to video succeed!')
@@ -228,6 +334,62 @@ def start() -> None:
         update_status('Processing to video failed!')
 
 
+def get_enabled_frame_processors() -> List[ModuleType]:
+    return [frame_processor for frame_processor in get_frame_processors_modules(roop.globals.frame_processors)
+            if not (frame_processor.NAME == 'ROOP.FACE-ENHANCER' and roop.globals.selected_enhancer in (None, 'None'))]
+
+
+def get_frame_processors_names(frame_processors: List[ModuleType]) -> str:
+    return ', '.join(frame_processor.NAME for frame_processor in frame_processors)
+
+
+def post_process(frame_processors: List[ModuleType]) -> None:
+    for frame_processor in frame_processors:
+        frame_processor.post_process()
+    release_resources()
+
+
+def prepare_video_job(target_path: str, frame_processors: List[ModuleType]) -> Optional[Dict[str, Any]]:
+    if not roop.globals.resume:
+        update_status('Creating temp resources...')
+        create_temp(target_path)
+        update_status('Extracting frames...')
+        extract_frames(target_path)
+        return None
+    processors = [frame_processor.NAME for frame_processor in frame_processors]
+    manifest = load_manifest(target_path)
+    if is_resumable(manifest, target_path, processors):
+        manifest['processors'] = processors
+        activate_manifest(manifest)
+        update_status(f'Resuming from frame {get_resume_index(manifest)} of {manifest["frame_total"]}...')
+        return get_active_manifest(target_path)
+    update_status('No matching job to resume, starting over...')
+    update_status('Creating temp resources...')
+    create_temp(target_path)
+    activate_manifest(create_manifest(target_path, processors))
+    update_status('Extracting frames...')
+    extract_frames(target_path)
+    manifest = get_active_manifest(target_path)
+    manifest['extracted'] = True
+    manifest['frame_total'] = len(get_temp_frame_paths(target_path))
+    save_manifest(manifest)
+    return manifest
+
+
+def stream_video(target_path: str, output_path: str) -> None:
+    frame_processors = get_enabled_frame_processors()
+    fps = 30.0
+    if roop.globals.keep_fps:
+        update_status('Detecting fps...')
+        fps = detect_fps(target_path)
+    keep_audio = not roop.globals.skip_audio and not has_extension(target_path, ['gif'])
+    if keep_audio and not roop.globals.keep_fps:
+        update_status('Restoring audio might cause issues as fps are not kept...')
+    update_status(f'Streaming video with {fps} fps...')
+    process_video_stream(roop.globals.SELECTED_FACE_DATA_INPUT, roop.globals.SELECTED_FACE_DATA_OUTPUT, target_path, output_path, fps, keep_audio, get_pipeline_stages(frame_processors))
+    post_process(frame_processors)
+
+
 def batch_process() -> None:
     files = [f for f in os.listdir(roop.globals.target_folder_path) if os.path.isfile(os.path.join(roop.globals.target_folder_path, f))]
     update_status('Sorting videos/images')
@@ -241,29 +403,21 @@ def batch_process() -> None:
         elif is_video(os.path.join(roop.globals.target_folder_path, f)):
             videofiles.append(os.path.join(roop.globals.target_folder_path, f))
 
-    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
-        if frame_processor.NAME == 'ROOP.FACE-ENHANCER' and roop.globals.selected_enhancer == 'None':
-            continue
-
-        update_status(f'{frame_processor.NAME} in progress...')
-        frame_processor.process_batch_images(roop.globals.SELECTED_FACE_DATA_INPUT, roop.globals.SELECTED_FACE_DATA_OUTPUT, imagefiles)
+    frame_processors = get_enabled_frame_processors()
+    update_status(f'{get_frame_processors_names(frame_processors)} in progress...')
+    process_batch(roop.globals.SELECTED_FACE_DATA_INPUT, roop.globals.SELECTED_FACE_DATA_OUTPUT, imagefiles, get_pipeline_stages(frame_processors))
 
     if len(videofiles) > 0:
         for video in videofiles:
             update_status(f'Processing {video}')
-            update_status('Creating temp resources...')
-            create_temp(video)
-            update_status('Extracting frames...')
-            extract_frames(video)
+            if roop.globals.stream_video:
+                stream_video(video, get_destfilename_from_path(video, roop.globals.output_path, '_fake.mp4'))
+                continue
+            manifest = prepare_video_job(video, frame_processors)
             temp_frame_paths = get_temp_frame_paths(video)
-            for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
-                if frame_processor.NAME == 'ROOP.FACE-ENHANCER' and roop.globals.selected_enhancer == 'None':
-                    continue
-
-                update_status(f'{frame_processor.NAME} in progress...')
-                frame_processor.process_video(roop.globals.SELECTED_FACE_DATA_INPUT, roop.globals.SELECTED_FACE_DATA_OUTPUT, temp_frame_paths)
-                frame_processor.post_process()
-                release_resources()
+            update_status(f'{get_frame_processors_names(frame_processors)} in progress...')
+            process_video(roop.globals.SELECTED_FACE_DATA_INPUT, roop.globals.SELECTED_FACE_DATA_OUTPUT, temp_frame_paths, get_pipeline_stages(frame_processors), manifest, video)
+            post_process(frame_processors)
             # handles fps
             if roop.globals.keep_fps:
                 update_status('Detecting fps...')
@@ -283,15 +437,15 @@ def batch_process() -> None:
                 else:
                     update_status('Restoring audio might cause issues as fps are not kept...')
                 restore_audio(video, roop.globals.output_path)
+            remove_manifest(video)
             clean_temp(video)
 
 
-
-
-
-
 def destroy() -> None:
-    if roop.globals.target_path:
+    release_process_pool()
+    save_active_manifest()
+    save_profile()
+    if roop.globals.target_path and not (roop.globals.resume and get_active_manifest(roop.globals.target_path)):
         clean_temp(roop.globals.target_path)
     sys.exit()
 
@@ -304,8 +458,13 @@ def run() -> None:
         if not frame_processor.pre_check():
             return
     limit_resources()
+    start_warm_up()
     if roop.globals.headless:
         start()
+        release_process_pool()
+        save_profile()
     else:
+        import roop.ui as ui
+
         window = ui.init(start, destroy)
         window.mainloop()
@@ -1,44 +1,159 @@
 import threading
-from typing import Any
-import insightface
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+import numpy
 
 import roop.globals
-from roop.typing import Frame
+from roop.typing import Face, Frame
 import cv2
 from PIL import Image
 from roop.capturer import get_video_frame
+from roop.model_registry import get_model
+from roop.profiler import profile_lock, profiled
+from roop.utilities import get_session_options
 
-FACE_ANALYSER = None
-THREAD_LOCK = threading.Lock()
+ANALYSIS_PROFILES: Dict[str, Optional[List[str]]] = {
+    'detection': ['detection'],
+    'recognition': ['detection', 'recognition'],
+    'full': None
+}
+FACE_TRACKER: Dict[str, Any] = {}
+FACE_TRACKER_LOCK = threading.Lock()
+TRACK_IDS = iter(range(1, 2 ** 63))
+TRACK_REGION_SCALE = 1.0
+TRACK_DETECT_SIZE = (320, 320)
+TRACK_MIN_IOU = 0.3
+SCENE_CHANGE_THRESHOLD = 30.0
 
 
-def get_face_analyser() -> Any:
-    global FACE_ANALYSER
+def get_analysis_profile() -> str:
+    profile = roop.globals.face_analysis_profile
+    if profile == 'auto':
+        return 'detection' if roop.globals.many_faces else 'recognition'
+    if profile == 'detection' and not roop.globals.many_faces:
+        return 'recognition'
+    return profile
 
-    with THREAD_LOCK:
-        if FACE_ANALYSER is None:
-            FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=roop.globals.execution_providers)
-            FACE_ANALYSER.prepare(ctx_id=0, det_size=(640, 640))
-    return FACE_ANALYSER
 
+def get_face_analyser(profile: Optional[str] = None) -> Any:
+    profile = profile or get_analysis_profile()
+    return get_model(f'face_analyser.{profile}', partial(create_face_analyser, profile))
 
-def get_one_face(frame: Frame) -> Any:
-    face = get_face_analyser().get(frame)
+
+def create_face_analyser(profile: str) -> Any:
+    from insightface.app import FaceAnalysis
+
+    face_analyser = FaceAnalysis(name='buffalo_l', allowed_modules=ANALYSIS_PROFILES[profile], providers=roop.globals.execution_providers, sess_options=get_session_options())
+    face_analyser.prepare(ctx_id=0, det_size=(roop.globals.face_detection_size, roop.globals.face_detection_size))
+    return face_analyser
+
+
+def warm_up_face_analyser(profile: Optional[str] = None) -> None:
+    get_face_analyser(profile).get(numpy.zeros((roop.globals.face_detection_size, roop.globals.face_detection_size, 3), dtype=numpy.uint8))
+
+
+def create_face(**kwargs: Any) -> Face:
+    from insightface.app.common import Face
+
+    return Face(**kwargs)
+
+
+@profiled('detect')
+def get_one_face(frame: Frame, profile: Optional[str] = None) -> Any:
+    face = get_face_analyser(profile).get(frame)
     try:
         return min(face, key=lambda x: x.bbox[0])
     except ValueError:
         return None
 
 
-def get_many_faces(frame: Frame) -> Any:
+@profiled('detect')
+def get_many_faces(frame: Frame, profile: Optional[str] = None) -> Any:
     try:
-        faces = get_face_analyser().get(frame)
+        faces = get_face_analyser(profile).get(frame)
         return sorted(faces, key = lambda x : x.bbox[0])
     except IndexError:
         return None
 
-def extract_face_images(source_filename, video_info):
-    face_data = []
+
+def reset_face_tracker() -> None:
+    with FACE_TRACKER_LOCK:
+        FACE_TRACKER.clear()
+
+
+def get_tracked_faces(frame: Frame) -> List[Face]:
+    with profile_lock('face_tracker', FACE_TRACKER_LOCK):
+        thumbnail = create_thumbnail(frame)
+        faces = None
+        if FACE_TRACKER.get('frames', 0) < roop.globals.face_detection_interval and not is_scene_change(FACE_TRACKER.get('thumbnail'), thumbnail):
+            faces = track_faces(frame, FACE_TRACKER['faces'])
+        if faces is None:
+            faces = assign_track_ids(get_many_faces(frame) or [], FACE_TRACKER.get('faces', []))
+            FACE_TRACKER['frames'] = 0
+        FACE_TRACKER['faces'] = faces
+        FACE_TRACKER['thumbnail'] = thumbnail
+        FACE_TRACKER['frames'] += 1
+    return faces
+
+
+def create_thumbnail(frame: Frame) -> Frame:
+    return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (64, 36), interpolation=cv2.INTER_AREA).astype(numpy.int16)
+
+
+def is_scene_change(previous_thumbnail: Optional[Frame], thumbnail: Frame) -> bool:
+    return previous_thumbnail is None or numpy.abs(thumbnail - previous_thumbnail).mean() > SCENE_CHANGE_THRESHOLD
+
+
+def calculate_iou(bbox: Any, other_bbox: Any) -> float:
+    width = max(min(bbox[2], other_bbox[2]) - max(bbox[0], other_bbox[0]), 0)
+    height = max(min(bbox[3], other_bbox[3]) - max(bbox[1], other_bbox[1]), 0)
+    intersection = width * height
+    union = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) + (other_bbox[2] - other_bbox[0]) * (other_bbox[3] - other_bbox[1]) - intersection
+    return float(intersection / union) if union > 0 else 0.0
+
+
+def assign_track_ids(faces: List[Face], tracked_faces: List[Face]) -> List[Face]:
+    for face in faces:
+        ious = [calculate_iou(face.bbox, tracked_face.bbox) for tracked_face in tracked_faces]
+        if ious and max(ious) >= TRACK_MIN_IOU:
+            face.track_id = tracked_faces[ious.index(max(ious))].track_id
+        else:
+            face.track_id = next(TRACK_IDS)
+        face.tracked = False
+    return faces
+
+
+def track_faces(frame: Frame, tracked_faces: List[Face]) -> Optional[List[Face]]:
+    frame_height, frame_width = frame.shape[:2]
+    faces = []
+    for tracked_face in tracked_faces:
+        start_x, start_y, end_x, end_y = tracked_face.bbox
+        margin_x = (end_x - start_x) * TRACK_REGION_SCALE
+        margin_y = (end_y - start_y) * TRACK_REGION_SCALE
+        region_x = int(max(start_x - margin_x, 0))
+        region_y = int(max(start_y - margin_y, 0))
+        region = frame[region_y:int(min(end_y + margin_y, frame_height)), region_x:int(min(end_x + margin_x, frame_width))]
+        if region.size == 0:
+            return None
+        bboxes, kpss = get_face_analyser().det_model.detect(region, input_size=TRACK_DETECT_SIZE, max_num=0, metric='default')
+        if bboxes.shape[0] == 0:
+            return None
+        offset = numpy.array([region_x, region_y], dtype=numpy.float32)
+        bboxes[:, 0:4] += numpy.tile(offset, 2)
+        ious = [calculate_iou(bbox, tracked_face.bbox) for bbox in bboxes]
+        best_index = int(numpy.argmax(ious))
+        if ious[best_index] < TRACK_MIN_IOU:
+            return None
+        face = create_face(bbox=bboxes[best_index, 0:4], kps=kpss[best_index] + offset if kpss is not None else None, det_score=bboxes[best_index, 4])
+        face.embedding = tracked_face.embedding
+        face.track_id = tracked_face.track_id
+        face.tracked = True
+        faces.append(face)
+    return sorted(faces, key=lambda x: x.bbox[0])
+
+
+def extract_face_images(source_filename: str, video_info: Tuple[bool, int], profile: str = 'full') -> List[List[Any]]:
+    face_data: List[List[Any]] = []
     source_image = None
     
     if video_info[0]:
@@ -51,7 +166,7 @@ def extract_face_images(source_filename, video_info):
         source_image = cv2.imread(source_filename)
 
         
-    faces = get_many_faces(source_image)
+    faces = get_many_faces(source_image, profile)
 
     i = 0
     for face in faces:
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy
+
+import roop.globals
+from roop.face_analyser import create_face, get_analysis_profile, get_many_faces, get_tracked_faces
+from roop.typing import Face, FrameContext
+
+FACE_CACHE: Dict[str, Any] = {}
+THREAD_LOCK = threading.Lock()
+
+
+def get_face_cache_path(target_path: str) -> str:
+    target_name, _ = os.path.splitext(target_path)
+    return f'{target_name}.{get_analysis_profile()}.faces.npz'
+
+
+def compute_content_hash(target_path: str) -> str:
+    content_hash = hashlib.sha1()
+    with open(target_path, 'rb') as target_file:
+        for chunk in iter(lambda: target_file.read(1024 * 1024), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def get_face_cache_settings() -> str:
+    return f'{get_analysis_profile()}:{roop.globals.face_detection_size}:{roop.globals.face_detection_interval}'
+
+
+def open_face_cache(target_path: Optional[str]) -> None:
+    with THREAD_LOCK:
+        FACE_CACHE.clear()
+        if not roop.globals.face_cache or not target_path:
+            return
+        target_stat = os.stat(target_path)
+        FACE_CACHE.update({'path': get_face_cache_path(target_path), 'target_path': target_path, 'target_stat': (target_stat.st_size, target_stat.st_mtime), 'frames': {}, 'changed': False})
+        if not os.path.isfile(FACE_CACHE['path']):
+            return
+        with numpy.load(FACE_CACHE['path']) as face_cache:
+            if str(face_cache['settings']) != get_face_cache_settings():
+                return
+            if tuple(face_cache['target_stat']) == FACE_CACHE['target_stat']:
+                FACE_CACHE['content_hash'] = str(face_cache['content_hash'])
+            elif str(face_cache['content_hash']) != get_content_hash():
+                return
+            FACE_CACHE['frames'] = decode_faces(face_cache)
+
+
+def get_content_hash() -> str:
+    if 'content_hash' not in FACE_CACHE:
+        FACE_CACHE['content_hash'] = compute_content_hash(FACE_CACHE['target_path'])
+    return FACE_CACHE['content_hash']
+
+
+def decode_faces(face_cache: Any) -> Dict[int, List[Face]]:
+    offsets = face_cache['offsets']
+    embeddings = face_cache['embeddings']
+    frames = {}
+    for frame_number, frame_index in enumerate(face_cache['frame_indices'].tolist()):
+        faces = []
+        for face_index in range(offsets[frame_number], offsets[frame_number + 1]):
+            face = create_face(bbox=face_cache['bboxes'][face_index], kps=face_cache['kps'][face_index], det_score=face_cache['det_scores'][face_index])
+            if embeddings.size:
+                face.embedding = embeddings[face_index]
+            faces.append(face)
+        frames[frame_index] = faces
+    return frames
+
+
+def close_face_cache() -> None:
+    with THREAD_LOCK:
+        if FACE_CACHE.get('changed'):
+            save_face_cache()
+        FACE_CACHE.clear()
+
+
+def save_face_cache() -> None:
+    frame_indices = sorted(FACE_CACHE['frames'])
+    faces = [face for frame_index in frame_indices for face in FACE_CACHE['frames'][frame_index]]
+    has_embeddings = bool(faces) and all(face.embedding is not None for face in faces)
+    face_cache_path = FACE_CACHE['path']
+    with open(face_cache_path + '.tmp', 'wb') as face_cache_file:
+        numpy.savez_compressed(
+            face_cache_file,
+            settings=get_face_cache_settings(),
+            content_hash=get_content_hash(),
+            target_stat=numpy.array(FACE_CACHE['target_stat']),
+            frame_indices=numpy.array(frame_indices, dtype=numpy.int32),
+            offsets=numpy.cumsum([0] + [len(FACE_CACHE['frames'][frame_index]) for frame_index in frame_indices]).astype(numpy.int32),
+            bboxes=numpy.array([face.bbox for face in faces], dtype=numpy.float32).reshape(-1, 4),
+            kps=numpy.array([face.kps for face in faces], dtype=numpy.float32).reshape(-1, 5, 2),
+            det_scores=numpy.array([face.det_score for face in faces], dtype=numpy.float32),
+            embeddings=numpy.array([face.embedding for face in faces] if has_embeddings else [], dtype=numpy.float32)
+        )
+    os.replace(face_cache_path + '.tmp', face_cache_path)
+
+
+def get_frame_faces(context: FrameContext) -> List[Face]:
+    if 'faces' not in context:
+        frame_index = context.get('frame_index')
+        faces = FACE_CACHE.get('frames', {}).get(frame_index)
+        if faces is None:
+            if roop.globals.face_detection_interval > 1 and frame_index is not None:
+                faces = get_tracked_faces(context['frame'])
+            else:
+                faces = get_many_faces(context['frame']) or []
+            if 'frames' in FACE_CACHE and frame_index is not None:
+                with THREAD_LOCK:
+                    FACE_CACHE['frames'][frame_index] = faces
+                    FACE_CACHE['changed'] = True
+        context['faces'] = faces
+    return context['faces']
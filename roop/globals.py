@@ -1,4 +1,4 @@
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 
 source_path = None
 target_path = None
@@ -8,21 +8,38 @@ target_folder_path = None
 frame_processors: List[str] = []
 keep_fps = None
 keep_frames = None
+resume = None
+stream_video = None
+frame_filter = False
 skip_audio = None
 many_faces = None
+face_detection_interval = 1
+face_analysis_profile = 'auto'
+face_detection_size = 640
+face_cache = None
 use_batch = None
-source_face_index = 0
-target_face_index = 0
+face_map: List[Tuple[int, int]] = [(0, 0)]
 face_position = None
 video_encoder = None
 video_quality = None
 max_memory = None
+model_memory_budget = None
+model_instances = None
 execution_providers: List[str] = []
-execution_threads = None
+execution_threads: Optional[int] = None
+execution_backend = 'thread'
+execution_ort_threads: Optional[int] = None
+pipeline_workers: Dict[str, int] = {}
+swap_batch_size = 1
 headless = None
 log_level = 'error'
-selected_enhancer = None
+selected_enhancer: Optional[str] = None
+enhancer_blend = 0.5
+enhancer_batch_size = 1
+enhancer_mask = 'ellipse'
+profile_path = None
 FACE_ENHANCER = None
 
 SELECTED_FACE_DATA_INPUT = None
 SELECTED_FACE_DATA_OUTPUT = None
+FACE_MAPPINGS: List[Tuple[Any, Any]] = []
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import roop.globals
+from roop.utilities import get_temp_directory_path
+
+MANIFEST_VERSION = 1
+MANIFEST_SAVE_INTERVAL = 2.0
+ACTIVE_MANIFEST: Dict[str, Any] = {}
+MANIFEST_SAVE_TIME = 0.0
+
+
+def get_manifest_path(target_path: str) -> str:
+    return get_temp_directory_path(target_path) + '.json'
+
+
+def get_staging_directory_path(target_path: str) -> str:
+    return os.path.join(get_temp_directory_path(target_path), 'staging')
+
+
+def get_source_hash() -> str:
+    source_hash = hashlib.sha1()
+    faces = [roop.globals.SELECTED_FACE_DATA_INPUT, roop.globals.SELECTED_FACE_DATA_OUTPUT]
+    for source_face, target_face in roop.globals.FACE_MAPPINGS:
+        faces.extend([source_face, target_face])
+    for face in faces:
+        source_hash.update(face.normed_embedding.tobytes() if face is not None and face.embedding is not None else b'-')
+    return source_hash.hexdigest()
+
+
+def get_job_settings() -> Dict[str, Any]:
+    return {
+        'many_faces': bool(roop.globals.many_faces),
+        'selected_enhancer': roop.globals.selected_enhancer,
+        'face_analysis_profile': roop.globals.face_analysis_profile,
+        'face_detection_size': roop.globals.face_detection_size
+    }
+
+
+def create_manifest(target_path: str, processors: List[str]) -> Dict[str, Any]:
+    target_stat = os.stat(target_path)
+    return {
+        'version': MANIFEST_VERSION,
+        'target_path': os.path.abspath(target_path),
+        'target_size': target_stat.st_size,
+        'target_mtime': target_stat.st_mtime,
+        'source_hash': get_source_hash(),
+        'settings': get_job_settings(),
+        'processors': processors,
+        'extracted': False,
+        'frame_total': 0,
+        'completed': {}
+    }
+
+
+def load_manifest(target_path: str) -> Optional[Dict[str, Any]]:
+    manifest_path = get_manifest_path(target_path)
+    if not os.path.isfile(manifest_path):
+        return None
+    try:
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_manifest(manifest: Dict[str, Any]) -> None:
+    global MANIFEST_SAVE_TIME
+
+    manifest_path = get_manifest_path(manifest['target_path'])
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    MANIFEST_SAVE_TIME = time.monotonic()
+
+
+def remove_manifest(target_path: str) -> None:
+    manifest_path = get_manifest_path(target_path)
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+    ACTIVE_MANIFEST.clear()
+
+
+def is_resumable(manifest: Optional[Dict[str, Any]], target_path: str, processors: List[str]) -> bool:
+    if not manifest or manifest.get('version') != MANIFEST_VERSION or not manifest.get('extracted'):
+        return False
+    if not os.path.isdir(get_temp_directory_path(target_path)):
+        return False
+    target_stat = os.stat(target_path)
+    if (manifest['target_size'], manifest['target_mtime']) != (target_stat.st_size, target_stat.st_mtime):
+        return False
+    if manifest['source_hash'] != get_source_hash() or manifest['settings'] != get_job_settings():
+        return False
+    completed = manifest['completed']
+    if any(count > 0 for name, count in completed.items() if name not in processors):
+        return False
+    counts = [completed.get(name, 0) for name in processors]
+    return all(count >= next_count for count, next_count in zip(counts, counts[1:]))
+
+
+def activate_manifest(manifest: Dict[str, Any]) -> None:
+    ACTIVE_MANIFEST.clear()
+    ACTIVE_MANIFEST.update(manifest)
+    save_manifest(ACTIVE_MANIFEST)
+
+
+def get_active_manifest(target_path: str) -> Optional[Dict[str, Any]]:
+    if ACTIVE_MANIFEST and ACTIVE_MANIFEST['target_path'] == os.path.abspath(target_path):
+        return ACTIVE_MANIFEST
+    return None
+
+
+def get_processed_processors(manifest: Dict[str, Any], frame_index: int) -> List[str]:
+    return [name for name in manifest['processors'] if manifest['completed'].get(name, 0) > frame_index]
+
+
+def get_resume_index(manifest: Dict[str, Any]) -> int:
+    return min([manifest['completed'].get(name, 0) for name in manifest['processors']] or [0])
+
+
+def complete_frame(manifest: Dict[str, Any], frame_index: int) -> None:
+    for name in manifest['processors']:
+        manifest['completed'][name] = max(manifest['completed'].get(name, 0), frame_index + 1)
+    if time.monotonic() - MANIFEST_SAVE_TIME > MANIFEST_SAVE_INTERVAL:
+        save_manifest(manifest)
+
+
+def save_active_manifest() -> None:
+    if ACTIVE_MANIFEST:
+        save_manifest(ACTIVE_MANIFEST)
@@ -0,0 +1,155 @@
+import gc
+import os
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import psutil
+
+import roop.globals
+from roop.profiler import profile_lock, profile_span
+
+MODELS: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+MODEL_FOOTPRINTS: Dict[str, int] = {}
+MODEL_POOLS: Dict[str, Dict[str, Any]] = {}
+MODEL_LOCKS: Dict[str, threading.Lock] = {}
+THREAD_LOCK = threading.RLock()
+MEASURE_LOCK = threading.Lock()
+POOL_CONDITION = threading.Condition()
+NAME = 'ROOP.MODEL-REGISTRY'
+
+
+def get_available_memory() -> int:
+    available_memory = psutil.virtual_memory().available
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        available_memory = min(available_memory, torch.cuda.mem_get_info()[0])
+    return available_memory
+
+
+def get_memory_usage() -> int:
+    memory_usage = psutil.Process(os.getpid()).memory_info().rss
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        memory_usage += torch.cuda.memory_allocated()
+    return memory_usage
+
+
+def get_model(name: str, create: Callable[[], Any], release: Optional[Callable[[Any], None]] = None) -> Any:
+    from roop.core import update_status
+
+    model = get_cached_model(name)
+    if model is not None:
+        return model
+    with profile_lock(name, get_model_lock(name)):
+        model = get_cached_model(name)
+        if model is not None:
+            return model
+        with profile_lock('model_registry', MEASURE_LOCK):
+            memory_usage = get_memory_usage()
+            with profile_span(f'load {name}', 'model'):
+                model = create()
+            footprint = max(get_memory_usage() - memory_usage, 0)
+        with THREAD_LOCK:
+            MODELS[name] = {'model': model, 'footprint': footprint, 'release': release}
+            MODEL_FOOTPRINTS[name] = footprint
+    update_status(f'Loaded {name} ({footprint / 1024 / 1024:.0f} MB)', NAME)
+    evict_models(name)
+    return model
+
+
+def get_cached_model(name: str) -> Any:
+    entry = MODELS.get(name)
+    if entry is None:
+        return None
+    try:
+        MODELS.move_to_end(name)
+    except KeyError:
+        pass
+    return entry['model']
+
+
+def get_model_lock(name: str) -> threading.Lock:
+    with THREAD_LOCK:
+        return MODEL_LOCKS.setdefault(name, threading.Lock())
+
+
+def evict_models(keep_name: str) -> None:
+    if not roop.globals.model_memory_budget:
+        return
+    memory_budget = roop.globals.model_memory_budget * 1024 * 1024 * 1024
+    with THREAD_LOCK:
+        while get_models_footprint() > memory_budget:
+            lru_name = next((name for name in MODELS if name != keep_name), None)
+            if lru_name is None:
+                break
+            release_model(lru_name)
+
+
+def release_model(name: str) -> None:
+    from roop.core import update_status
+
+    with THREAD_LOCK:
+        entry = MODELS.pop(name, None)
+    if entry is None:
+        return
+    if entry['release']:
+        entry['release'](entry['model'])
+    update_status(f'Released {name} ({entry["footprint"] / 1024 / 1024:.0f} MB)', NAME)
+    del entry
+    gc.collect()
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def get_models_footprint() -> int:
+    with THREAD_LOCK:
+        return sum(entry['footprint'] for entry in MODELS.values())
+
+
+@contextmanager
+def use_model_instance(name: str, create: Callable[[], Any]) -> Iterator[Any]:
+    with profile_span(f'acquire {name}', 'lock'):
+        index = acquire_model_slot(name)
+    try:
+        yield get_model(f'{name}.{index}', create)
+    finally:
+        release_model_slot(name, index)
+
+
+def acquire_model_slot(name: str) -> int:
+    with POOL_CONDITION:
+        model_pool = MODEL_POOLS.setdefault(name, {'idle': [], 'count': 0})
+        while True:
+            if model_pool['idle']:
+                return model_pool['idle'].pop()
+            if can_add_model_instance(name, model_pool['count']):
+                model_pool['count'] += 1
+                return model_pool['count'] - 1
+            POOL_CONDITION.wait()
+
+
+def release_model_slot(name: str, index: int) -> None:
+    with POOL_CONDITION:
+        MODEL_POOLS[name]['idle'].append(index)
+        POOL_CONDITION.notify_all()
+
+
+def get_max_model_instances() -> int:
+    return roop.globals.model_instances or roop.globals.execution_threads or 1
+
+
+def can_add_model_instance(name: str, count: int) -> bool:
+    if count == 0:
+        return True
+    if roop.globals.model_instances:
+        return count < roop.globals.model_instances
+    footprint = MODEL_FOOTPRINTS.get(f'{name}.0')
+    if footprint is None or count >= get_max_model_instances():
+        return False
+    if roop.globals.model_memory_budget and get_models_footprint() + footprint > roop.globals.model_memory_budget * 1024 * 1024 * 1024:
+        return False
+    return get_available_memory() > footprint * 2
@@ -1,15 +1,24 @@
 import os
 import sys
+import shutil
 import importlib
+import cv2
 import psutil
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from queue import Queue
+from functools import partial
 from types import ModuleType
-from typing import Any, List, Callable
-from roop.typing import Face
+from typing import Any, Dict, List, Callable, Iterator, Optional
+from roop.typing import Face, Frame, FrameContext
 from tqdm import tqdm
 
 import roop
+from roop.capturer import get_video_frame_total
+from roop.face_analyser import reset_face_tracker
+from roop.face_cache import open_face_cache, close_face_cache
+from roop.job_manifest import get_staging_directory_path, get_resume_index, get_processed_processors, complete_frame, save_manifest
+from roop.processors.frame.multiprocess import process_frame_in_pool
+from roop.processors.frame.pipeline import Stage, run_pipeline
+from roop.processors.frame.prefilter import reset_frame_filter, filter_frame, is_filtered_frame, learn_frame, report_filter_stats
+from roop.utilities import get_destfilename_from_path, detect_resolution, create_frame_pool, read_video_frames, open_video_writer, write_video_frame, close_video_writer
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
 FRAME_PROCESSORS_INTERFACE = [
@@ -19,6 +28,8 @@ FRAME_PROCESSORS_INTERFACE = [
     'process_frames',
     'process_image',
     'process_video',
+    'get_pipeline_stages',
+    'get_warm_up_tasks',
     'post_process'
 ]
 
@@ -48,44 +59,200 @@ def get_frame_processors_modules(frame_processors: List[str]) -> List[ModuleType
     return FRAME_PROCESSORS_MODULES
 
 
-def multi_process_frame(is_batch: bool, source_face: Face, target_face: Face, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], update: Callable[[], None]) -> None:
-    with ThreadPoolExecutor(max_workers=roop.globals.execution_threads) as executor:
-        futures = []
-        queue = create_queue(temp_frame_paths)
-        queue_per_future = max(len(temp_frame_paths) // roop.globals.execution_threads, 1)
-        while not queue.empty():
-            future = executor.submit(process_frames, is_batch, source_face, target_face, pick_queue(queue, queue_per_future), update)
-            futures.append(future)
-        for future in as_completed(futures):
-            future.result()
+def get_pipeline_stages(frame_processors: List[ModuleType]) -> List[Stage]:
+    if roop.globals.execution_backend == 'process':
+        return [('process', partial(process_frame_stage, process_frame_in_pool), get_stage_workers('process'), False)]
+    return [(name, partial(process_processor_stage, frame_processor.NAME, process), get_stage_workers(name), ordered) for frame_processor in frame_processors for name, process, ordered in frame_processor.get_pipeline_stages()]
 
 
-def create_queue(temp_frame_paths: List[str]) -> Queue[str]:
-    queue: Queue[str] = Queue()
-    for frame_path in temp_frame_paths:
-        queue.put(frame_path)
-    return queue
+def get_stage_workers(name: str) -> int:
+    return roop.globals.pipeline_workers.get(name, roop.globals.execution_threads)
 
 
-def pick_queue(queue: Queue[str], queue_per_future: int) -> List[str]:
-    queues = []
-    for _ in range(queue_per_future):
-        if not queue.empty():
-            queues.append(queue.get())
-    return queues
+def get_max_pending(stages: List[Stage]) -> int:
+    return sum(workers for _, _, workers, _ in stages) + 2
 
-def process_batch(source_face: Face, target_face: Face, frame_paths: list[str], process_frames: Callable[[str, List[str], Any], None]) -> None:
+
+def process_frame_stage(process: Callable[[FrameContext], None], context: FrameContext) -> None:
+    if context.get('frame') is not None and not is_filtered_frame(context):
+        process(context)
+
+
+def process_processor_stage(processor_name: str, process: Callable[[FrameContext], None], context: FrameContext) -> None:
+    if processor_name not in context.get('processed', ()):
+        process_frame_stage(process, context)
+
+
+def decode_frame(context: FrameContext) -> None:
+    context['frame'] = cv2.imread(context['frame_path'])
+
+
+def encode_frame(context: FrameContext) -> None:
+    if context.get('frame') is not None and not is_filtered_frame(context):
+        write_frame(context['output_path'], context['frame'])
+
+
+def get_partial_path(frame_path: str) -> str:
+    frame_name, frame_extension = os.path.splitext(frame_path)
+    return f'{frame_name}.partial{frame_extension}'
+
+
+def write_frame(frame_path: str, frame: Frame) -> None:
+    partial_path = get_partial_path(frame_path)
+    if cv2.imwrite(partial_path, frame):
+        os.replace(partial_path, frame_path)
+
+
+def copy_frame(source_path: str, frame_path: str) -> None:
+    if source_path != frame_path:
+        partial_path = get_partial_path(frame_path)
+        shutil.copyfile(source_path, partial_path)
+        os.replace(partial_path, frame_path)
+
+
+def get_filter_stages() -> List[Stage]:
+    if roop.globals.frame_filter:
+        return [('filter', partial(process_frame_stage, filter_frame), 1, True)]
+    return []
+
+
+def create_frame_contexts(source_face: Face, target_face: Face, frame_paths: List[str], output_paths: List[str]) -> Iterator[FrameContext]:
+    for frame_path, output_path in zip(frame_paths, output_paths):
+        yield {'source_face': source_face, 'target_face': target_face, 'frame_path': frame_path, 'output_path': output_path}
+
+
+def process_frame_paths(source_face: Face, target_face: Face, frame_paths: List[str], output_paths: List[str], stages: List[Stage]) -> None:
     progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+    stages = [('decode', decode_frame, get_stage_workers('decode'), False)] + stages + [('encode', encode_frame, get_stage_workers('encode'), False)]
     total = len(frame_paths)
     with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
-        multi_process_frame(True, source_face, target_face, frame_paths, process_frames, lambda: update_progress(progress))
+        run_pipeline(create_frame_contexts(source_face, target_face, frame_paths, output_paths), stages, lambda context: update_progress(progress), get_max_pending(stages))
+
+
+def create_video_frame_contexts(source_face: Face, target_face: Face, frame_paths: List[str], manifest: Optional[Dict[str, Any]]) -> Iterator[FrameContext]:
+    start_index = get_resume_index(manifest) if manifest else 0
+    staging_directory_path = get_staging_directory_path(manifest['target_path']) if manifest else None
+    for frame_index in range(start_index, len(frame_paths)):
+        frame_path = frame_paths[frame_index]
+        context = {'source_face': source_face, 'target_face': target_face, 'frame_path': frame_path, 'output_path': frame_path, 'frame_index': frame_index}
+        if manifest and staging_directory_path:
+            context['output_path'] = os.path.join(staging_directory_path, os.path.basename(frame_path))
+            context['processed'] = get_processed_processors(manifest, frame_index)
+            if context['processed'] and os.path.isfile(context['output_path']):
+                context['frame_path'] = context['output_path']
+        yield context
 
 
-def process_video(source_face: Face, target_face: Face, frame_paths: list[str], process_frames: Callable[[str, List[str], Any], None]) -> None:
+def merge_staging_frames(frame_paths: List[str], manifest: Dict[str, Any]) -> None:
+    staging_directory_path = get_staging_directory_path(manifest['target_path'])
+    for frame_path in frame_paths:
+        staging_frame_path = os.path.join(staging_directory_path, os.path.basename(frame_path))
+        if os.path.isfile(staging_frame_path):
+            os.replace(staging_frame_path, frame_path)
+
+
+def process_video_frame_paths(source_face: Face, target_face: Face, frame_paths: List[str], stages: List[Stage], manifest: Optional[Dict[str, Any]], target_path: Optional[str]) -> None:
     progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+    stages = [('decode', decode_frame, get_stage_workers('decode'), False)] + get_filter_stages() + stages + [('encode', encode_frame, get_stage_workers('encode'), False)]
     total = len(frame_paths)
+    previous_frame_path = None
+
+    def finish_frame(context: FrameContext) -> None:
+        nonlocal previous_frame_path
+
+        if context.get('duplicate') and previous_frame_path:
+            copy_frame(previous_frame_path, context['output_path'])
+        else:
+            previous_frame_path = context['output_path'] if os.path.isfile(context['output_path']) else context['frame_path']
+        if manifest:
+            complete_frame(manifest, context['frame_index'])
+        learn_frame(context)
+        update_progress(progress)
+
+    if manifest:
+        os.makedirs(get_staging_directory_path(manifest['target_path']), exist_ok=True)
+    reset_face_tracker()
+    reset_frame_filter()
+    open_face_cache(target_path)
+    initial = get_resume_index(manifest) if manifest else 0
+    with tqdm(total=total, initial=initial, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+        try:
+            run_pipeline(create_video_frame_contexts(source_face, target_face, frame_paths, manifest), stages, finish_frame, get_max_pending(stages))
+        finally:
+            close_face_cache()
+    if manifest:
+        save_manifest(manifest)
+        merge_staging_frames(frame_paths, manifest)
+    if roop.globals.frame_filter:
+        report_filter_stats(total)
+
+
+def process_batch(source_face: Face, target_face: Face, frame_paths: List[str], stages: List[Stage]) -> None:
+    output_paths = [get_destfilename_from_path(frame_path, roop.globals.output_path, '_fake.png') for frame_path in frame_paths]
+    process_frame_paths(source_face, target_face, frame_paths, output_paths, stages)
+
+
+def process_video(source_face: Face, target_face: Face, frame_paths: List[str], stages: List[Stage], manifest: Optional[Dict[str, Any]] = None, target_path: Optional[str] = None) -> None:
+    process_video_frame_paths(source_face, target_face, frame_paths, stages, manifest, target_path)
+
+
+def process_frame_chain(frame_processors: List[ModuleType], source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
+    context: FrameContext = {'source_face': source_face, 'target_face': target_face, 'frame': temp_frame}
+    for frame_processor in frame_processors:
+        for _, process, _ in frame_processor.get_pipeline_stages():
+            process_frame_stage(process, context)
+    return context['frame']
+
+
+def process_image_chain(frame_processors: List[ModuleType], source_face: Face, target_face: Face, target_path: str, output_path: str) -> None:
+    target_frame = cv2.imread(target_path)
+    if target_frame is not None:
+        result = process_frame_chain(frame_processors, source_face, target_face, target_frame)
+        if result is not None:
+            cv2.imwrite(output_path, result)
+
+
+def create_stream_contexts(source_face: Face, target_face: Face, temp_frames: Iterator[Frame]) -> Iterator[FrameContext]:
+    for frame_index, temp_frame in enumerate(temp_frames):
+        yield {'source_face': source_face, 'target_face': target_face, 'frame': temp_frame, 'buffer': temp_frame, 'frame_index': frame_index}
+
+
+def process_video_stream(source_face: Face, target_face: Face, target_path: str, output_path: str, fps: float, keep_audio: bool, stages: List[Stage]) -> bool:
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+    stages = get_filter_stages() + stages
+    resolution = detect_resolution(target_path)
+    pool_size = get_max_pending(stages)
+    frame_pool = create_frame_pool(resolution, pool_size + 1)
+    writer = open_video_writer(target_path, output_path, resolution, fps, keep_audio)
+    previous_context = None
+
+    def encode_stream_frame(context: FrameContext) -> None:
+        nonlocal previous_context
+
+        if context.get('duplicate') and previous_context:
+            write_video_frame(writer, previous_context['frame'])
+            frame_pool.put(context['buffer'])
+        else:
+            write_video_frame(writer, context['frame'])
+            if previous_context:
+                frame_pool.put(previous_context['buffer'])
+            previous_context = context
+        learn_frame(context)
+        update_progress(progress)
+
+    total = get_video_frame_total(target_path)
+    reset_face_tracker()
+    reset_frame_filter()
+    open_face_cache(target_path)
     with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
-        multi_process_frame(False, source_face, target_face, frame_paths, process_frames, lambda: update_progress(progress))
+        try:
+            run_pipeline(create_stream_contexts(source_face, target_face, read_video_frames(target_path, resolution, frame_pool)), stages, encode_stream_frame, pool_size)
+        finally:
+            close_face_cache()
+            done = close_video_writer(writer)
+    if roop.globals.frame_filter:
+        report_filter_stats(total)
+    return done
 
 
 def update_progress(progress: Any = None) -> None:
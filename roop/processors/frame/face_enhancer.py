@@ -1,26 +1,29 @@
-from typing import Any, List, Callable
+import sys
+from functools import partial
+from typing import Any, Dict, List, Callable, Optional, Tuple
 import cv2
 import threading
 
 import roop.globals
 import roop.processors.frame.core
-import torch
 
+from roop.batcher import Batcher, create_batcher, submit_batch_item, close_batcher
 from roop.core import update_status
-from roop.face_analyser import get_one_face
-from roop.typing import Frame, Face
+from roop.face_analyser import get_many_faces
+from roop.face_cache import get_frame_faces
+from roop.model_registry import get_max_model_instances
+from roop.profiler import profile_span, profiled
+from roop.typing import Frame, Face, FrameContext
 from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video, get_destfilename_from_path
-from PIL import Image
-from numpy import asarray
-from enhancer.GFPGAN import enhance_GFPGAN
-from enhancer.Codeformer import enhance_Codeformer
-#from enhancer.DMDNet import DMDNet, enhance_DMDNet
-
-FACE_ENHANCER = None
-THREAD_SEMAPHORE = threading.Semaphore()
+import numpy
+
+RESTORE_BATCHERS: Dict[str, Batcher] = {}
+FACE_MASKS: Dict[Tuple[int, int], Frame] = {}
+SOURCE_CROPS: Dict[Tuple[str, bytes], Optional[Frame]] = {}
 THREAD_LOCK = threading.Lock()
 NAME = 'ROOP.FACE-ENHANCER'
-
+FACE_SIZE = (512, 512)
+FACE_TEMPLATE = numpy.array([[192.98138, 239.94708], [318.90277, 240.1936], [256.63416, 314.01935], [201.26117, 371.41043], [313.08905, 371.15118]], dtype=numpy.float32)
 
 
 def pre_check() -> bool:
@@ -35,43 +38,189 @@ def pre_start() -> bool:
     if not is_image(roop.globals.target_path) and not is_video(roop.globals.target_path):
         update_status('Select an image or video for target path.', NAME)
         return False
+    if roop.globals.enhancer_mask == 'parse' and roop.globals.selected_enhancer != 'Codeformer':
+        update_status('The parse mask only applies to CodeFormer, blending with the square face mask.', NAME)
     return True
 
 
 def post_process() -> None:
-    FACE_ENHANCER = None
+    with THREAD_LOCK:
+        restore_batchers = list(RESTORE_BATCHERS.values())
+        RESTORE_BATCHERS.clear()
+    for restore_batcher in restore_batchers:
+        close_batcher(restore_batcher)
+    with THREAD_LOCK:
+        SOURCE_CROPS.clear()
+    dmdnet = sys.modules.get('enhancer.DMDNet')
+    if dmdnet is not None:
+        dmdnet.clear_specific_dictionaries()
+
+
+def get_warm_up_tasks() -> List[Tuple[str, Callable[[], Any]]]:
+    blank_face = numpy.zeros(FACE_SIZE + (3,), dtype=numpy.uint8)
+    if roop.globals.selected_enhancer == "DMDNet":
+        from enhancer.DMDNet import get_face_alignment, restore_crops_DMDNet
+
+        return [('face_alignment', get_face_alignment), ('dmdnet', partial(restore_crops_DMDNet, [blank_face], [None]))]
+    if roop.globals.selected_enhancer in ("Codeformer", "GFPGAN"):
+        return [(roop.globals.selected_enhancer.lower(), partial(run_restorer, roop.globals.selected_enhancer, [blank_face]))]
+    return []
+
+
+def get_restore_batcher(selected_enhancer: str) -> Batcher:
+    with THREAD_LOCK:
+        if selected_enhancer not in RESTORE_BATCHERS:
+            RESTORE_BATCHERS[selected_enhancer] = create_batcher(partial(run_restorer, selected_enhancer), roop.globals.enhancer_batch_size, workers=get_max_model_instances())
+        return RESTORE_BATCHERS[selected_enhancer]
+
+
+@profiled('enhancer')
+def run_restorer(selected_enhancer: str, cropped_faces: List[Frame]) -> List[Frame]:
+    if selected_enhancer == "Codeformer":
+        from enhancer.Codeformer import restore_crops_Codeformer
+
+        return restore_crops_Codeformer(cropped_faces)
+    from enhancer.GFPGAN import restore_crops_GFPGAN
+
+    return restore_crops_GFPGAN(cropped_faces)
+
+
+def align_faces(temp_frame: Frame, faces: List[Face]) -> List[Tuple[int, Frame, Any]]:
+    aligned_faces = []
+    for face_index, face in enumerate(faces):
+        affine_matrix = cv2.estimateAffinePartial2D(face.kps, FACE_TEMPLATE, method=cv2.LMEDS)[0]
+        if affine_matrix is not None:
+            aligned_faces.append((face_index, cv2.warpAffine(temp_frame, affine_matrix, FACE_SIZE, borderValue=(135, 133, 132)), affine_matrix))
+    return aligned_faces
+
+
+def restore_crops(cropped_faces: List[Frame]) -> List[Frame]:
+    selected_enhancer = roop.globals.selected_enhancer
+    if roop.globals.enhancer_batch_size > 1:
+        restore_batcher = get_restore_batcher(selected_enhancer)
+        return [future.result() for future in [submit_batch_item(restore_batcher, cropped_face) for cropped_face in cropped_faces]]
+    return run_restorer(selected_enhancer, cropped_faces)
+
+
+def get_source_crop(source_face: Optional[Face]) -> Optional[Tuple[Tuple[str, bytes], Frame]]:
+    if source_face is None or not roop.globals.source_path:
+        return None
+    identity = (roop.globals.source_path, source_face.kps.tobytes())
+    with THREAD_LOCK:
+        if identity not in SOURCE_CROPS:
+            source_frame = cv2.imread(roop.globals.source_path)
+            aligned_faces = align_faces(source_frame, [source_face]) if source_frame is not None else []
+            SOURCE_CROPS[identity] = aligned_faces[0][1] if aligned_faces else None
+    if SOURCE_CROPS[identity] is None:
+        return None
+    return identity, SOURCE_CROPS[identity]
+
+
+def get_face_masks(restored_faces: List[Frame]) -> List[Optional[Frame]]:
+    if roop.globals.selected_enhancer != "Codeformer":
+        return [None] * len(restored_faces)
+    if roop.globals.enhancer_mask == 'parse':
+        from enhancer.Codeformer import parse_Codeformer
+
+        return list(parse_Codeformer(restored_faces))
+    return [get_face_mask(restored_face.shape[:2]) for restored_face in restored_faces]
+
+
+def enhance_face(temp_frame: Frame, faces: List[Face], source_faces: Optional[List[Optional[Face]]] = None) -> Frame:
+    if roop.globals.selected_enhancer not in ("Codeformer", "DMDNet", "GFPGAN"):
+        return temp_frame
+    aligned_faces = align_faces(temp_frame, faces)
+    if not aligned_faces:
+        return temp_frame
+    cropped_faces = [cropped_face for _, cropped_face, _ in aligned_faces]
+    if roop.globals.selected_enhancer == "DMDNet":
+        from enhancer.DMDNet import restore_crops_DMDNet
+
+        source_crops = [get_source_crop(source_faces[face_index]) if source_faces else None for face_index, _, _ in aligned_faces]
+        with profile_span('enhancer', 'model'):
+            cropped_faces = restore_crops_DMDNet(cropped_faces, source_crops)
+    else:
+        cropped_faces = restore_crops(cropped_faces)
+    restored_faces = list(zip(cropped_faces, [affine_matrix for _, _, affine_matrix in aligned_faces]))
+    face_masks = get_face_masks([restored_face for restored_face, _ in restored_faces])
+    if not temp_frame.flags.writeable:
+        temp_frame = temp_frame.copy()
+    for (restored_face, affine_matrix), face_mask in zip(restored_faces, face_masks):
+        paste_restored_face(temp_frame, restored_face, affine_matrix, face_mask, roop.globals.enhancer_blend)
+    return temp_frame
 
 
-def enhance_face(temp_frame: Frame) -> Frame:
+def get_face_mask(face_shape: Tuple[int, int]) -> Frame:
+    face_mask = FACE_MASKS.get(face_shape)
+    if face_mask is None:
+        face_height, face_width = face_shape
+        face_mask = numpy.zeros(face_shape, dtype=numpy.float32)
+        cv2.ellipse(face_mask, (face_width // 2, face_height * 9 // 16), (face_width * 3 // 8, face_height * 7 // 16), 0, 0, 360, 1, -1)
+        blur_size = face_width // 16 * 2 + 1
+        face_mask = cv2.GaussianBlur(face_mask, (blur_size, blur_size), 0)
+        FACE_MASKS[face_shape] = face_mask
+    return face_mask
+
+
+@profiled('enhance_paste')
+def paste_restored_face(temp_frame: Frame, restored_face: Frame, affine_matrix: Any, face_mask: Optional[Frame], blend_ratio: float) -> None:
+    inverse_matrix = cv2.invertAffineTransform(affine_matrix)
+    face_height, face_width = restored_face.shape[:2]
+    corners = cv2.transform(numpy.array([[[0, 0], [face_width, 0], [0, face_height], [face_width, face_height]]], dtype=numpy.float32), inverse_matrix)[0]
+    frame_height, frame_width = temp_frame.shape[:2]
+    start_x, start_y = numpy.maximum(numpy.floor(corners.min(axis=0)).astype(int) - 1, 0)
+    end_x, end_y = numpy.minimum(numpy.ceil(corners.max(axis=0)).astype(int) + 1, (frame_width, frame_height))
+    if start_x >= end_x or start_y >= end_y:
+        return
+    inverse_matrix[:, 2] -= (start_x, start_y)
+    paste_size = (end_x - start_x, end_y - start_y)
+    paste_face = cv2.warpAffine(restored_face, inverse_matrix, paste_size)
+    if face_mask is None:
+        paste_mask = get_square_paste_mask(face_height, face_width, inverse_matrix, paste_size)
+    else:
+        paste_mask = cv2.warpAffine(face_mask, inverse_matrix, paste_size)
+    paste_mask = paste_mask[:, :, None] * blend_ratio
+    paste_frame = temp_frame[start_y:end_y, start_x:end_x]
+    paste_frame[:] = (paste_mask * paste_face + (1 - paste_mask) * paste_frame).astype(numpy.uint8)
+
+
+def get_square_paste_mask(face_height: int, face_width: int, inverse_matrix: Any, paste_size: Tuple[int, int]) -> Frame:
+    paste_mask = cv2.warpAffine(numpy.ones((face_height, face_width), dtype=numpy.float32), inverse_matrix, paste_size)
+    # remove the black borders and soften the edges depending on the face size
+    paste_mask = cv2.erode(paste_mask, numpy.ones((2, 2), numpy.uint8))
+    edge_size = int(numpy.sum(paste_mask) ** 0.5) // 20
+    if edge_size > 0:
+        paste_mask = cv2.erode(paste_mask, numpy.ones((edge_size * 2, edge_size * 2), numpy.uint8))
+        paste_mask = cv2.GaussianBlur(paste_mask, (edge_size * 2 + 1, edge_size * 2 + 1), 0)
+    return paste_mask
+
+
+def process_frame(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
+    faces = get_many_faces(temp_frame)
+    if faces:
+        temp_frame = enhance_face(temp_frame, faces)
+    return temp_frame
 
-    with THREAD_SEMAPHORE:
-        temp_frame_original = Image.fromarray(temp_frame)
-        with THREAD_LOCK:
-            if roop.globals.selected_enhancer == "DMDNet":
-                #return enhance_DMDNet(temp_frame)
-                return temp_frame
-            elif roop.globals.selected_enhancer == "Codeformer":
-                temp_frame = enhance_Codeformer(temp_frame)
-            elif roop.globals.selected_enhancer == "GFPGAN":
-                temp_frame = enhance_GFPGAN(temp_frame)  
-            else:
-                return temp_frame
 
-        temp_frame = Image.blend(temp_frame_original, Image.fromarray(temp_frame), 0.5)
-    return asarray(temp_frame)
+def enhance_frame(context: FrameContext) -> None:
+    faces = get_frame_faces(context)
+    if faces:
+        context['frame'] = enhance_face(context['frame'], faces, get_swapped_source_faces(faces, context.get('face_pairs', [])))
+
+
+def get_swapped_source_faces(faces: List[Face], face_pairs: List[Tuple[Face, Face]]) -> List[Optional[Face]]:
+    return [next((source_face for source_face, target_face in face_pairs if target_face is face), None) for face in faces]
 
-def process_frame(source_path: str, temp_frame: Frame) -> Frame:
-    target_face = get_one_face(temp_frame)
-    if target_face:
-        temp_frame = enhance_face(temp_frame)
-    return temp_frame
+
+def get_pipeline_stages() -> List[Tuple[str, Callable[[FrameContext], None], bool]]:
+    return [('enhance', enhance_frame, False)]
 
 
 def process_frames(is_batch: bool, source_face: Face, target_face: Face, temp_frame_paths: List[str], update: Callable[[], None]) -> None:
     for temp_frame_path in temp_frame_paths:
         temp_frame = cv2.imread(temp_frame_path)
         if temp_frame is not None:
-            result = process_frame(None, temp_frame)
+            result = process_frame(None, None, temp_frame)
         if result is not None:
             if is_batch:
                 tf = get_destfilename_from_path(temp_frame_path, roop.globals.output_path, '_fake.png')
@@ -85,17 +234,14 @@ def process_frames(is_batch: bool, source_face: Face, target_face: Face, temp_fr
 def process_image(source_face: Face, target_face: Face, target_path: str, output_path: str) -> None:
     target_frame = cv2.imread(target_path)
     if target_frame is not None:
-        result = process_frame(None, target_frame)
+        result = process_frame(None, None, target_frame)
     if result is not None:
         cv2.imwrite(output_path, result)
 
 
 def process_video(source_face: Any, target_face: Any, temp_frame_paths: List[str]) -> None:
-    roop.processors.frame.core.process_video(source_face, target_face, temp_frame_paths, process_frames)
+    roop.processors.frame.core.process_video(source_face, target_face, temp_frame_paths, roop.processors.frame.core.get_pipeline_stages([sys.modules[__name__]]))
 
 
 def process_batch_images(source_face: Any, target_face: Any, temp_frame_paths: List[str]) -> None:
-    global DIST_THRESHOLD
-
-    DIST_THRESHOLD = 0.85
-    roop.processors.frame.core.process_video(source_face, target_face, temp_frame_paths, process_frames)
+    roop.processors.frame.core.process_batch(source_face, target_face, temp_frame_paths, roop.processors.frame.core.get_pipeline_stages([sys.modules[__name__]]))
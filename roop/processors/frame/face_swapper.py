@@ -1,16 +1,28 @@
-from typing import Any, List, Callable
+import sys
+from functools import partial
+from typing import Any, Dict, List, Callable, Optional, Tuple
 import cv2
-import insightface
+import numpy
 import threading
+from insightface.model_zoo.inswapper import INSwapper
+from insightface.utils import face_align
 
 import roop.globals
 import roop.processors.frame.core
+from roop.batcher import Batcher, create_batcher, submit_batch_item, close_batcher
 from roop.core import update_status
-from roop.face_analyser import get_one_face, get_many_faces
-from roop.typing import Face, Frame
-from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video, compute_cosine_distance, get_destfilename_from_path
+from roop.face_analyser import get_analysis_profile, get_one_face, get_many_faces, warm_up_face_analyser
+from roop.face_cache import get_frame_faces
+from roop.model_registry import get_model
+from roop.profiler import profile_lock, profiled
+from roop.typing import Face, Frame, FrameContext
+from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video, get_destfilename_from_path, create_inference_session
 
-FACE_SWAPPER = None
+SWAP_BATCHER: Optional[Batcher] = None
+SOURCE_LATENTS: Dict[bytes, Any] = {}
+SOURCE_LATENTS_SIZE = 16
+TRACK_MATCHES: Dict[int, int] = {}
+IDENTITY_INDEX: Dict[str, Any] = {}
 THREAD_LOCK = threading.Lock()
 NAME = 'ROOP.FACE-SWAPPER'
 
@@ -18,13 +30,25 @@ DIST_THRESHOLD = 0.65
 
 
 def get_face_swapper() -> Any:
-    global FACE_SWAPPER
+    return get_model('face_swapper', create_face_swapper)
 
-    with THREAD_LOCK:
-        if FACE_SWAPPER is None:
-            model_path = resolve_relative_path('../models/inswapper_128.onnx')
-            FACE_SWAPPER = insightface.model_zoo.get_model(model_path, providers=roop.globals.execution_providers)
-    return FACE_SWAPPER
+
+def create_face_swapper() -> Any:
+    model_path = resolve_relative_path('../models/inswapper_128.onnx')
+    return INSwapper(model_file=model_path, session=create_inference_session(model_path))
+
+
+def get_warm_up_tasks() -> List[Tuple[str, Callable[[], Any]]]:
+    warm_up_tasks: List[Tuple[str, Callable[[], Any]]] = [('face_analyser.recognition', partial(warm_up_face_analyser, 'recognition'))]
+    if get_analysis_profile() != 'recognition':
+        warm_up_tasks.append((f'face_analyser.{get_analysis_profile()}', warm_up_face_analyser))
+    warm_up_tasks.append(('face_swapper', warm_up_face_swapper))
+    return warm_up_tasks
+
+
+def warm_up_face_swapper() -> None:
+    face_swapper = get_face_swapper()
+    run_swapper([(numpy.zeros((1, 3) + face_swapper.input_size[::-1], dtype=numpy.float32), numpy.zeros((1, face_swapper.emap.shape[1]), dtype=numpy.float32))])
 
 
 def pre_check() -> bool:
@@ -43,48 +67,196 @@ def pre_start() -> bool:
     if not is_image(roop.globals.target_path) and not is_video(roop.globals.target_path):
         update_status('Select an image or video for target path.', NAME)
         return False
+    if roop.globals.swap_batch_size > 1 and not has_dynamic_batch(get_face_swapper()):
+        update_status('The inswapper model has a fixed batch size, swapping faces one at a time.', NAME)
     return True
 
 
 def post_process() -> None:
-    global FACE_SWAPPER
+    global SWAP_BATCHER
+
+    TRACK_MATCHES.clear()
+    with THREAD_LOCK:
+        swap_batcher, SWAP_BATCHER = SWAP_BATCHER, None
+    if swap_batcher:
+        close_batcher(swap_batcher)
 
-    FACE_SWAPPER = None
 
+def get_swap_batcher() -> Batcher:
+    global SWAP_BATCHER
 
-def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    return get_face_swapper().get(temp_frame, target_face, source_face, paste_back=True)
+    with THREAD_LOCK:
+        if SWAP_BATCHER is None:
+            SWAP_BATCHER = create_batcher(run_swapper, roop.globals.swap_batch_size)
+    return SWAP_BATCHER
 
 
-def process_frame(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    global DIST_THRESHOLD
+def get_source_latent(source_face: Face) -> Any:
+    source_embedding = source_face.normed_embedding
+    source_key = source_embedding.tobytes()
+    with profile_lock('face_swapper', THREAD_LOCK):
+        latent = SOURCE_LATENTS.get(source_key)
+    if latent is None:
+        latent = numpy.dot(source_embedding.reshape((1, -1)), get_face_swapper().emap)
+        latent /= numpy.linalg.norm(latent)
+        with profile_lock('face_swapper', THREAD_LOCK):
+            while len(SOURCE_LATENTS) >= SOURCE_LATENTS_SIZE:
+                del SOURCE_LATENTS[next(iter(SOURCE_LATENTS))]
+            SOURCE_LATENTS[source_key] = latent
+    return latent
 
-    if roop.globals.many_faces:
-        many_faces = get_many_faces(temp_frame)
-        if many_faces:
-            for target_face in many_faces:
-                if target_face['det_score'] > 0.65:
-                    temp_frame = swap_face(source_face, target_face, temp_frame)
+
+def has_dynamic_batch(face_swapper: Any) -> bool:
+    return not all(isinstance(swapper_input.shape[0], int) for swapper_input in face_swapper.session.get_inputs())
+
+
+@profiled('inswapper')
+def run_swapper(swap_inputs: List[Tuple[Any, Any]]) -> List[Frame]:
+    face_swapper = get_face_swapper()
+    blobs = numpy.concatenate([blob for blob, _ in swap_inputs])
+    latents = numpy.concatenate([latent for _, latent in swap_inputs]).astype(numpy.float32)
+    if has_dynamic_batch(face_swapper):
+        predictions = face_swapper.session.run(face_swapper.output_names, {face_swapper.input_names[0]: blobs, face_swapper.input_names[1]: latents})[0]
     else:
-        if target_face:
-            target_embedding = target_face.embedding
-            many_faces = get_many_faces(temp_frame)
-            target_face = None
-            for dest_face in many_faces:
-                dest_embedding = dest_face.embedding
-                if compute_cosine_distance(target_embedding, dest_embedding) <= DIST_THRESHOLD:
-                    target_face = dest_face
-                    break
-            if target_face:
-                temp_frame = swap_face(source_face, target_face, temp_frame)
-            return temp_frame
-                    
-        target_face = get_one_face(temp_frame)
-        if target_face:
-            temp_frame = swap_face(source_face, target_face, temp_frame)
+        predictions = numpy.concatenate([face_swapper.session.run(face_swapper.output_names, {face_swapper.input_names[0]: blobs[index:index + 1], face_swapper.input_names[1]: latents[index:index + 1]})[0] for index in range(len(swap_inputs))])
+    return [numpy.clip(255 * prediction.transpose((1, 2, 0)), 0, 255).astype(numpy.uint8)[:, :, ::-1] for prediction in predictions]
+
+
+def create_swap_input(source_face: Face, crop_frame: Frame) -> Tuple[Any, Any]:
+    face_swapper = get_face_swapper()
+    blob = cv2.dnn.blobFromImage(crop_frame, 1.0 / face_swapper.input_std, face_swapper.input_size, (face_swapper.input_mean, face_swapper.input_mean, face_swapper.input_mean), swapRB=True)
+    return blob, get_source_latent(source_face)
+
+
+def swap_crops(face_pairs: List[Tuple[Face, Frame]]) -> List[Frame]:
+    swap_inputs = [create_swap_input(source_face, crop_frame) for source_face, crop_frame in face_pairs]
+    if roop.globals.swap_batch_size > 1 and has_dynamic_batch(get_face_swapper()):
+        swap_batcher = get_swap_batcher()
+        return [future.result() for future in [submit_batch_item(swap_batcher, swap_input) for swap_input in swap_inputs]]
+    return run_swapper(swap_inputs)
+
+
+def get_paste_area(temp_frame: Frame, crop_frame: Frame, inverse_matrix: Any) -> Tuple[int, int, int, int]:
+    crop_height, crop_width = crop_frame.shape[:2]
+    corners = cv2.transform(numpy.array([[[0, 0], [crop_width, 0], [0, crop_height], [crop_width, crop_height]]], dtype=numpy.float32), inverse_matrix)[0]
+    start_x, start_y = numpy.floor(corners.min(axis=0)).astype(int)
+    end_x, end_y = numpy.ceil(corners.max(axis=0)).astype(int)
+    padding = max(end_x - start_x, end_y - start_y) // 10 + 12
+    frame_height, frame_width = temp_frame.shape[:2]
+    return max(start_x - padding, 0), max(start_y - padding, 0), min(end_x + padding, frame_width), min(end_y + padding, frame_height)
+
+
+@profiled('paste_back')
+def paste_back(temp_frame: Frame, swapped_frame: Frame, crop_frame: Frame, affine_matrix: Any) -> Frame:
+    inverse_matrix = cv2.invertAffineTransform(affine_matrix)
+    start_x, start_y, end_x, end_y = get_paste_area(temp_frame, crop_frame, inverse_matrix)
+    if start_x >= end_x or start_y >= end_y:
+        return temp_frame
+    if not temp_frame.flags.writeable:
+        temp_frame = temp_frame.copy()
+    inverse_matrix[:, 2] -= (start_x, start_y)
+    paste_size = (end_x - start_x, end_y - start_y)
+    crop_mask = numpy.full(crop_frame.shape[:2], 255, dtype=numpy.float32)
+    swapped_frame = cv2.warpAffine(swapped_frame, inverse_matrix, paste_size, borderValue=0.0)
+    crop_mask = cv2.warpAffine(crop_mask, inverse_matrix, paste_size, borderValue=0.0)
+    crop_mask[crop_mask > 20] = 255
+    mask_h_inds, mask_w_inds = numpy.where(crop_mask == 255)
+    if mask_h_inds.size == 0:
+        return temp_frame
+    mask_size = int(numpy.sqrt((numpy.max(mask_h_inds) - numpy.min(mask_h_inds)) * (numpy.max(mask_w_inds) - numpy.min(mask_w_inds))))
+    erode_size = max(mask_size // 10, 10)
+    crop_mask = cv2.erode(crop_mask, numpy.ones((erode_size, erode_size), numpy.uint8), iterations=1)
+    blur_size = max(mask_size // 20, 5) * 2 + 1
+    crop_mask = cv2.GaussianBlur(crop_mask, (blur_size, blur_size), 0)
+    crop_mask = numpy.reshape(crop_mask / 255, [crop_mask.shape[0], crop_mask.shape[1], 1])
+    paste_frame = temp_frame[start_y:end_y, start_x:end_x]
+    paste_frame[:] = (crop_mask * swapped_frame + (1 - crop_mask) * paste_frame.astype(numpy.float32)).astype(numpy.uint8)
+    return temp_frame
+
+
+def swap_faces(face_pairs: List[Tuple[Face, Face]], temp_frame: Frame) -> Frame:
+    crop_size = get_face_swapper().input_size[0]
+    crops = [face_align.norm_crop2(temp_frame, target_face.kps, crop_size) for _, target_face in face_pairs]
+    swapped_frames = swap_crops([(source_face, crop_frame) for (source_face, _), (crop_frame, _) in zip(face_pairs, crops)])
+    for swapped_frame, (crop_frame, affine_matrix) in zip(swapped_frames, crops):
+        temp_frame = paste_back(temp_frame, swapped_frame, crop_frame, affine_matrix)
     return temp_frame
 
 
+def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
+    return swap_faces([(source_face, target_face)], temp_frame)
+
+
+def get_face_mappings(source_face: Face, target_face: Face) -> List[Tuple[Face, Face]]:
+    if roop.globals.FACE_MAPPINGS:
+        return roop.globals.FACE_MAPPINGS
+    if target_face:
+        return [(source_face, target_face)]
+    return []
+
+
+def get_identity_index(face_mappings: List[Tuple[Face, Face]]) -> Any:
+    index_key = b''.join(target_face.normed_embedding.tobytes() for _, target_face in face_mappings)
+    with THREAD_LOCK:
+        if IDENTITY_INDEX.get('key') != index_key:
+            IDENTITY_INDEX['key'] = index_key
+            IDENTITY_INDEX['embeddings'] = numpy.stack([target_face.normed_embedding for _, target_face in face_mappings])
+            TRACK_MATCHES.clear()
+        return IDENTITY_INDEX['embeddings']
+
+
+def match_identities(identity_embeddings: Any, faces: List[Face]) -> List[int]:
+    similarities = numpy.stack([face.normed_embedding for face in faces]) @ identity_embeddings.T
+    best_identities = similarities.argmax(axis=1)
+    best_similarities = similarities[numpy.arange(len(faces)), best_identities]
+    identities = [-1] * len(faces)
+    for identity in numpy.unique(best_identities):
+        candidates = numpy.flatnonzero((best_identities == identity) & (best_similarities >= 1 - DIST_THRESHOLD))
+        if candidates.size:
+            identities[candidates[best_similarities[candidates].argmax()]] = int(identity)
+    return identities
+
+
+def get_face_identities(face_mappings: List[Tuple[Face, Face]], faces: List[Face]) -> List[int]:
+    identity_embeddings = get_identity_index(face_mappings)
+    identities = [TRACK_MATCHES.get(face.track_id, -1) for face in faces]
+    unmatched = [index for index, face in enumerate(faces) if not face.tracked or face.track_id not in TRACK_MATCHES]
+    if unmatched:
+        for index, identity in zip(unmatched, match_identities(identity_embeddings, [faces[index] for index in unmatched])):
+            identities[index] = identity
+            if faces[index].track_id is not None:
+                TRACK_MATCHES[faces[index].track_id] = identity
+    return identities
+
+
+def get_face_pairs(source_face: Face, target_face: Face, many_faces: List[Face]) -> List[Tuple[Face, Face]]:
+    if roop.globals.many_faces:
+        return [(source_face, face) for face in many_faces if face['det_score'] > 0.65]
+    face_mappings = get_face_mappings(source_face, target_face)
+    if face_mappings:
+        if not many_faces:
+            return []
+        return [(face_mappings[identity][0], face) for face, identity in zip(many_faces, get_face_identities(face_mappings, many_faces)) if identity >= 0]
+    if many_faces:
+        return [(source_face, many_faces[0])]
+    return []
+
+
+def process_frame(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
+    return swap_faces(get_face_pairs(source_face, target_face, get_many_faces(temp_frame) or []), temp_frame)
+
+
+def detect_frame_faces(context: FrameContext) -> None:
+    context['face_pairs'] = get_face_pairs(context['source_face'], context['target_face'], get_frame_faces(context))
+
+
+def swap_frame_faces(context: FrameContext) -> None:
+    context['frame'] = swap_faces(context['face_pairs'], context['frame'])
+
+
+def get_pipeline_stages() -> List[Tuple[str, Callable[[FrameContext], None], bool]]:
+    return [('detect', detect_frame_faces, roop.globals.face_detection_interval > 1), ('swap', swap_frame_faces, False)]
+
 
 def process_frames(is_batch: bool, source_face: Face, target_face: Face, temp_frame_paths: List[str], update: Callable[[], None]) -> None:
     for temp_frame_path in temp_frame_paths:
@@ -112,12 +284,8 @@ def process_image(source_face: Any, target_face: Any, target_path: str, output_p
 
 
 def process_video(source_face: Any, target_face: Any, temp_frame_paths: List[str]) -> None:
-    global DIST_THRESHOLD
-
-    roop.processors.frame.core.process_video(source_face, target_face, temp_frame_paths, process_frames)
+    roop.processors.frame.core.process_video(source_face, target_face, temp_frame_paths, roop.processors.frame.core.get_pipeline_stages([sys.modules[__name__]]))
 
 
 def process_batch_images(source_face: Any, target_face: Any, temp_frame_paths: List[str]) -> None:
-    global DIST_THRESHOLD
-
-    roop.processors.frame.core.process_batch(source_face, target_face, temp_frame_paths, process_frames)
+    roop.processors.frame.core.process_batch(source_face, target_face, temp_frame_paths, roop.processors.frame.core.get_pipeline_stages([sys.modules[__name__]]))
@@ -0,0 +1,139 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy
+
+import roop.globals
+from roop.face_analyser import create_face
+from roop.typing import Face, FrameContext
+
+PROCESS_POOL: Optional[ProcessPoolExecutor] = None
+PROCESS_POOL_STATE: Dict[str, Any] = {}
+SHARED_FRAMES: List[shared_memory.SharedMemory] = []
+ATTACHED_FRAMES: Dict[str, shared_memory.SharedMemory] = {}
+THREAD_LOCK = threading.Lock()
+GLOBAL_TYPES = (str, int, float, bool, list, dict, tuple, type(None))
+GLOBAL_PATHS = ('target_path', 'output_path', 'target_folder_path')
+
+
+def get_globals_state() -> Dict[str, Any]:
+    return {name: value for name, value in vars(roop.globals).items() if name.islower() and not name.startswith('_') and name not in GLOBAL_PATHS and isinstance(value, GLOBAL_TYPES)}
+
+
+def suggest_process_threads(processes: int) -> int:
+    return max((os.cpu_count() or 1) // max(processes, 1), 1)
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global PROCESS_POOL, PROCESS_POOL_STATE
+
+    with THREAD_LOCK:
+        globals_state = get_globals_state()
+        if PROCESS_POOL is not None and PROCESS_POOL_STATE != globals_state:
+            PROCESS_POOL.shutdown()
+            PROCESS_POOL = None
+        if PROCESS_POOL is None:
+            processes = roop.globals.pipeline_workers.get('process', roop.globals.execution_threads)
+            PROCESS_POOL = ProcessPoolExecutor(max_workers=processes, mp_context=get_context('spawn'), initializer=init_process_worker, initargs=(globals_state, suggest_process_threads(processes)))
+            PROCESS_POOL_STATE = globals_state
+    return PROCESS_POOL
+
+
+def release_process_pool() -> None:
+    global PROCESS_POOL
+
+    with THREAD_LOCK:
+        if PROCESS_POOL is not None:
+            PROCESS_POOL.shutdown()
+            PROCESS_POOL = None
+        for shared_frame in SHARED_FRAMES:
+            shared_frame.close()
+            shared_frame.unlink()
+        SHARED_FRAMES.clear()
+
+
+def init_process_worker(globals_state: Dict[str, Any], threads: int) -> None:
+    for name, value in globals_state.items():
+        setattr(roop.globals, name, value)
+    roop.globals.execution_threads = 1
+    roop.globals.execution_ort_threads = threads
+    cv2.setNumThreads(threads)
+    from roop.face_analyser import get_face_analyser
+    from roop.processors.frame.core import get_frame_processors_modules
+
+    get_face_analyser()
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        if frame_processor.NAME == 'ROOP.FACE-SWAPPER':
+            frame_processor.get_face_swapper()
+
+
+def acquire_shared_frame(size: int) -> shared_memory.SharedMemory:
+    with THREAD_LOCK:
+        shared_frame = SHARED_FRAMES.pop() if SHARED_FRAMES else None
+    if shared_frame is not None and shared_frame.size < size:
+        shared_frame.close()
+        shared_frame.unlink()
+        shared_frame = None
+    if shared_frame is None:
+        shared_frame = shared_memory.SharedMemory(create=True, size=size)
+    return shared_frame
+
+
+def release_shared_frame(shared_frame: shared_memory.SharedMemory) -> None:
+    with THREAD_LOCK:
+        SHARED_FRAMES.append(shared_frame)
+
+
+def attach_shared_frame(name: str) -> shared_memory.SharedMemory:
+    shared_frame = ATTACHED_FRAMES.get(name)
+    if shared_frame is None:
+        try:
+            shared_frame = shared_memory.SharedMemory(name=name, track=False)  # type: ignore[call-arg]
+        except TypeError:
+            shared_frame = shared_memory.SharedMemory(name=name)
+        ATTACHED_FRAMES[name] = shared_frame
+    return shared_frame
+
+
+def encode_face(face: Face) -> Optional[Dict[str, Any]]:
+    if face:
+        return dict(face)
+    return None
+
+
+def decode_face(face: Optional[Dict[str, Any]]) -> Face:
+    if face:
+        return create_face(**face)
+    return None
+
+
+def process_shared_frame(name: str, shape: Tuple[int, ...], source_face: Optional[Dict[str, Any]], target_face: Optional[Dict[str, Any]], face_mappings: List[Tuple[Dict[str, Any], Dict[str, Any]]], processed: List[str]) -> None:
+    from roop.processors.frame.core import get_frame_processors_modules, process_frame_chain
+    from roop.core import get_enabled_frame_processors
+
+    roop.globals.FACE_MAPPINGS = [(decode_face(mapped_source_face), decode_face(mapped_target_face)) for mapped_source_face, mapped_target_face in face_mappings]
+    temp_frame = numpy.ndarray(shape, dtype=numpy.uint8, buffer=attach_shared_frame(name).buf)
+    get_frame_processors_modules(roop.globals.frame_processors)
+    frame_processors = [frame_processor for frame_processor in get_enabled_frame_processors() if frame_processor.NAME not in processed]
+    result = process_frame_chain(frame_processors, decode_face(source_face), decode_face(target_face), temp_frame)
+    if result is not temp_frame:
+        numpy.copyto(temp_frame, result)
+
+
+def process_frame_in_pool(context: FrameContext) -> None:
+    temp_frame = context['frame']
+    shared_frame = acquire_shared_frame(temp_frame.nbytes)
+    try:
+        shared_temp_frame = numpy.ndarray(temp_frame.shape, dtype=numpy.uint8, buffer=shared_frame.buf)
+        numpy.copyto(shared_temp_frame, temp_frame)
+        get_process_pool().submit(process_shared_frame, shared_frame.name, temp_frame.shape, encode_face(context['source_face']), encode_face(context['target_face']), [(encode_face(mapped_source_face), encode_face(mapped_target_face)) for mapped_source_face, mapped_target_face in roop.globals.FACE_MAPPINGS], list(context.get('processed', []))).result()
+        if temp_frame.flags.writeable:
+            numpy.copyto(temp_frame, shared_temp_frame)
+        else:
+            context['frame'] = shared_temp_frame.copy()
+    finally:
+        release_shared_frame(shared_frame)
@@ -0,0 +1,105 @@
+import threading
+from queue import Queue
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+from roop.profiler import profile_span
+from roop.typing import FrameContext
+
+Stage = Tuple[str, Callable[[FrameContext], None], int, bool]
+
+
+def run_pipeline(contexts: Iterable[FrameContext], stages: List[Stage], sink: Callable[[FrameContext], None], max_pending: int) -> None:
+    stage_workers = [1 if ordered else max(workers, 1) for _, _, workers, ordered in stages] + [1]
+    queues: List['Queue[Any]'] = [Queue(maxsize=workers * 2) for workers in stage_workers[:-1]]
+    queues.append(Queue())
+    pending = threading.Semaphore(max_pending)
+    errors: List[BaseException] = []
+    threads = [threading.Thread(target=feed_pipeline, args=(contexts, queues[0], pending, errors, stage_workers[0]), daemon=True)]
+    for stage_index, (name, process, _, ordered) in enumerate(stages):
+        stage_state = {'workers': stage_workers[stage_index], 'ordered': ordered, 'completed': {}, 'next_index': 0, 'lock': threading.Lock()}
+        for _ in range(stage_workers[stage_index]):
+            threads.append(threading.Thread(target=run_stage_worker, args=(name, process, queues[stage_index], queues[stage_index + 1], stage_workers[stage_index + 1], stage_state, errors), daemon=True))
+    for thread in threads:
+        thread.start()
+    drain_pipeline(queues[-1], sink, pending, errors)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def feed_pipeline(contexts: Iterable[FrameContext], queue: 'Queue[Any]', pending: threading.Semaphore, errors: List[BaseException], workers: int) -> None:
+    iterator = iter(contexts)
+    index = 0
+    while not errors:
+        pending.acquire()
+        try:
+            with profile_span('read', 'stage', index):
+                context = next(iterator)
+        except StopIteration:
+            pending.release()
+            break
+        except Exception as exception:
+            errors.append(exception)
+            pending.release()
+            break
+        context['index'] = index
+        index += 1
+        queue.put(context)
+    close = getattr(iterator, 'close', None)
+    if close:
+        close()
+    for _ in range(workers):
+        queue.put(None)
+
+
+def run_stage_worker(name: str, process: Callable[[FrameContext], None], input_queue: 'Queue[Any]', output_queue: 'Queue[Any]', next_workers: int, stage_state: Dict[str, Any], errors: List[BaseException]) -> None:
+    while True:
+        context = input_queue.get()
+        if context is None:
+            break
+        for context in order_contexts(context, stage_state):
+            if not errors:
+                try:
+                    with profile_span(name, 'stage', context.get('frame_index', context['index'])):
+                        process(context)
+                except Exception as exception:
+                    errors.append(exception)
+            output_queue.put(context)
+    with stage_state['lock']:
+        stage_state['workers'] -= 1
+        if stage_state['workers'] == 0:
+            for _ in range(next_workers):
+                output_queue.put(None)
+
+
+def order_contexts(context: FrameContext, stage_state: Dict[str, Any]) -> List[FrameContext]:
+    if not stage_state['ordered']:
+        return [context]
+    completed = stage_state['completed']
+    completed[context['index']] = context
+    contexts = []
+    while stage_state['next_index'] in completed:
+        contexts.append(completed.pop(stage_state['next_index']))
+        stage_state['next_index'] += 1
+    return contexts
+
+
+def drain_pipeline(queue: 'Queue[Any]', sink: Callable[[FrameContext], None], pending: threading.Semaphore, errors: List[BaseException]) -> None:
+    completed: Dict[int, FrameContext] = {}
+    next_index = 0
+    while True:
+        context = queue.get()
+        if context is None:
+            break
+        completed[context['index']] = context
+        while next_index in completed:
+            context = completed.pop(next_index)
+            if not errors:
+                try:
+                    with profile_span('sink', 'stage', context.get('frame_index', context['index'])):
+                        sink(context)
+                except Exception as exception:
+                    errors.append(exception)
+            pending.release()
+            next_index += 1
@@ -0,0 +1,68 @@
+import threading
+from typing import Any, Dict
+
+import cv2
+import numpy
+
+from roop.face_analyser import create_thumbnail
+from roop.typing import Frame, FrameContext
+
+FRAME_FILTER: Dict[str, Any] = {}
+FACE_FREE_FRAMES: Dict[bytes, Frame] = {}
+FACE_FREE_FRAMES_SIZE = 64
+THREAD_LOCK = threading.Lock()
+NAME = 'ROOP.FRAME-FILTER'
+DUPLICATE_THRESHOLD = 2
+FACE_FREE_THRESHOLD = 8
+
+
+def reset_frame_filter() -> None:
+    with THREAD_LOCK:
+        FRAME_FILTER.clear()
+        FRAME_FILTER.update({'duplicate': 0, 'face_free': 0})
+        FACE_FREE_FRAMES.clear()
+
+
+def compute_frame_hash(thumbnail: Frame) -> bytes:
+    hash_frame = cv2.resize(thumbnail.astype(numpy.uint8), (9, 8), interpolation=cv2.INTER_AREA)
+    return numpy.packbits(hash_frame[:, 1:] > hash_frame[:, :-1]).tobytes()
+
+
+def is_same_frame(thumbnail: Frame, other_thumbnail: Frame, threshold: int) -> bool:
+    return int(numpy.abs(thumbnail - other_thumbnail).max()) <= threshold
+
+
+def filter_frame(context: FrameContext) -> None:
+    thumbnail = create_thumbnail(context['frame'])
+    frame_hash = compute_frame_hash(thumbnail)
+    context['thumbnail'] = thumbnail
+    context['frame_hash'] = frame_hash
+    previous_thumbnail = FRAME_FILTER.get('thumbnail')
+    if previous_thumbnail is not None and is_same_frame(previous_thumbnail, thumbnail, DUPLICATE_THRESHOLD):
+        context['duplicate'] = True
+        FRAME_FILTER['duplicate'] += 1
+        return
+    FRAME_FILTER['thumbnail'] = thumbnail
+    with THREAD_LOCK:
+        face_free_thumbnail = FACE_FREE_FRAMES.get(frame_hash)
+    if face_free_thumbnail is not None and is_same_frame(face_free_thumbnail, thumbnail, FACE_FREE_THRESHOLD):
+        context['face_free'] = True
+        FRAME_FILTER['face_free'] += 1
+
+
+def is_filtered_frame(context: FrameContext) -> bool:
+    return bool(context.get('duplicate') or context.get('face_free'))
+
+
+def learn_frame(context: FrameContext) -> None:
+    if 'frame_hash' in context and not is_filtered_frame(context) and context.get('faces') == []:
+        with THREAD_LOCK:
+            while len(FACE_FREE_FRAMES) >= FACE_FREE_FRAMES_SIZE:
+                del FACE_FREE_FRAMES[next(iter(FACE_FREE_FRAMES))]
+            FACE_FREE_FRAMES[context['frame_hash']] = context['thumbnail']
+
+
+def report_filter_stats(total: int) -> None:
+    from roop.core import update_status
+
+    update_status(f'Skipped {FRAME_FILTER["duplicate"]} duplicate and {FRAME_FILTER["face_free"]} face-free frames of {total}', NAME)
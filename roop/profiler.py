@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import roop.globals
+
+PROFILE_EVENTS: List[Dict[str, Any]] = []
+THREAD_NAMES: Dict[int, str] = {}
+PROFILE_START = time.perf_counter()
+LOCK_WAIT_THRESHOLD = 0.0001
+
+
+def is_profiling() -> bool:
+    return bool(roop.globals.profile_path)
+
+
+def record_event(name: str, category: str, start_time: float, end_time: float, cpu_time: Optional[float], args: Optional[Dict[str, Any]] = None) -> None:
+    thread = threading.current_thread()
+    THREAD_NAMES.setdefault(thread.ident or 0, thread.name)
+    event: Dict[str, Any] = {'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident or 0, 'ts': (start_time - PROFILE_START) * 1000000, 'dur': (end_time - start_time) * 1000000, 'args': dict(args or {})}
+    if cpu_time is not None:
+        event['args']['cpu'] = cpu_time * 1000000
+    PROFILE_EVENTS.append(event)
+
+
+@contextmanager
+def profile_span(name: str, category: str = 'stage', frame_index: Optional[int] = None) -> Iterator[None]:
+    if not is_profiling():
+        yield
+        return
+    start_time = time.perf_counter()
+    start_cpu_time = time.thread_time()
+    try:
+        yield
+    finally:
+        record_event(name, category, start_time, time.perf_counter(), time.thread_time() - start_cpu_time, {'frame': frame_index} if frame_index is not None else None)
+
+
+@contextmanager
+def profile_lock(name: str, lock: Any) -> Iterator[None]:
+    if not is_profiling():
+        with lock:
+            yield
+        return
+    start_time = time.perf_counter()
+    with lock:
+        acquire_time = time.perf_counter()
+        if acquire_time - start_time > LOCK_WAIT_THRESHOLD:
+            record_event(f'wait {name}', 'lock', start_time, acquire_time, None)
+        try:
+            yield
+        finally:
+            record_event(f'hold {name}', 'lock', acquire_time, time.perf_counter(), None)
+
+
+def profiled(name: str, category: str = 'model') -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    def decorate(function: Callable[..., Any]) -> Callable[..., Any]:
+        @wraps(function)
+        def profiled_function(*args: Any, **kwargs: Any) -> Any:
+            with profile_span(name, category):
+                return function(*args, **kwargs)
+        return profiled_function
+    return decorate
+
+
+def get_profile_summary(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    spans: Dict[Any, List[Dict[str, Any]]] = {}
+    for event in events:
+        spans.setdefault((event['cat'], event['name']), []).append(event)
+    summary = []
+    for (category, name), events in spans.items():
+        durations = sorted(event['dur'] / 1000 for event in events)
+        summary.append({
+            'category': category,
+            'name': name,
+            'count': len(events),
+            'wall_ms': sum(durations),
+            'cpu_ms': sum(event['args'].get('cpu', 0) / 1000 for event in events),
+            'mean_ms': sum(durations) / len(durations),
+            'p95_ms': durations[min(int(len(durations) * 0.95), len(durations) - 1)]
+        })
+    return sorted(summary, key=lambda row: row['wall_ms'], reverse=True)
+
+
+def format_profile_summary(summary: List[Dict[str, Any]]) -> str:
+    lines = [f'{"category":<8} {"name":<32} {"count":>8} {"wall ms":>12} {"cpu ms":>12} {"mean ms":>10} {"p95 ms":>10}']
+    for row in summary:
+        lines.append(f'{row["category"]:<8} {row["name"]:<32} {row["count"]:>8} {row["wall_ms"]:>12.1f} {row["cpu_ms"]:>12.1f} {row["mean_ms"]:>10.2f} {row["p95_ms"]:>10.2f}')
+    return '\n'.join(lines)
+
+
+def save_profile() -> None:
+    if not is_profiling() or not PROFILE_EVENTS:
+        return
+    profile_path = roop.globals.profile_path
+    events = PROFILE_EVENTS[:]
+    del PROFILE_EVENTS[:len(events)]
+    metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread_id, 'args': {'name': thread_name}} for thread_id, thread_name in list(THREAD_NAMES.items())]
+    with open(profile_path, 'w') as profile_file:
+        json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, profile_file)
+    summary = get_profile_summary(events)
+    profile_name, _ = os.path.splitext(profile_path)
+    with open(profile_name + '.summary.json', 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print(format_profile_summary(summary))
@@ -1,7 +1,10 @@
-from typing import Any
+from typing import TYPE_CHECKING, Any, Dict
 
-from insightface.app.common import Face
 import numpy
 
-Face = Face
+if TYPE_CHECKING:
+    from insightface.app.common import Face
+else:
+    Face = Dict[str, Any]
 Frame = numpy.ndarray[Any, Any]
+FrameContext = Dict[str, Any]
@@ -73,7 +73,7 @@ def create_root(start: Callable, destroy: Callable) -> ctk.CTk:
     enhance_label.place(relx=base_x1, rely=0.49)
     enhance_label.configure(text_color=ctk.ThemeManager.theme.get('RoopDonate').get('text_color'))
     
-    enhancer_cb = ctk.CTkComboBox(root, values=["None", "Codeformer", "DMDNet (unavailable)", "GFPGAN"], width=IMAGE_BUTTON_WIDTH, command=select_enhancer)
+    enhancer_cb = ctk.CTkComboBox(root, values=["None", "Codeformer", "DMDNet", "GFPGAN"], width=IMAGE_BUTTON_WIDTH, command=select_enhancer)
     enhancer_cb.set("None")
     enhancer_cb.place(relx=base_x1, rely=0.532)
     
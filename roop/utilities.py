@@ -1,4 +1,5 @@
 import glob
+import json
 import mimetypes
 import os
 import platform
@@ -6,14 +7,19 @@ import shutil
 import ssl
 import subprocess
 import sys
+import threading
 import urllib
 
+from contextlib import suppress
 from pathlib import Path
-from typing import List, Any
+from queue import Queue
+from typing import List, Any, Iterator, Tuple
 from tqdm import tqdm
-from scipy.spatial import distance
+import numpy
 
 import roop.globals
+from roop.profiler import profiled
+from roop.typing import Frame
 
 TEMP_FILE = 'temp.mp4'
 TEMP_DIRECTORY = 'temp'
@@ -34,6 +40,12 @@ def run_ffmpeg(args: List[str]) -> bool:
     return False
 
 
+def open_ffmpeg(args: List[str], stdin: bool = False, stdout: bool = False) -> 'subprocess.Popen[bytes]':
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', roop.globals.log_level]
+    commands.extend(args)
+    return subprocess.Popen(commands, stdin=subprocess.PIPE if stdin else None, stdout=subprocess.PIPE if stdout else None)
+
+
 def detect_fps(target_path: str) -> float:
     command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=r_frame_rate', '-of', 'default=noprint_wrappers=1:nokey=1', target_path]
     output = subprocess.check_output(command).decode().strip().split('/')
@@ -45,11 +57,79 @@ def detect_fps(target_path: str) -> float:
     return 30.0
 
 
+def detect_resolution(target_path: str) -> Tuple[int, int]:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height:stream_tags=rotate:stream_side_data=rotation', '-of', 'json', target_path]
+    stream = json.loads(subprocess.check_output(command).decode())['streams'][0]
+    width, height = int(stream['width']), int(stream['height'])
+    rotation = int(stream.get('tags', {}).get('rotate', 0))
+    for side_data in stream.get('side_data_list', []):
+        rotation = int(side_data.get('rotation', rotation))
+    if abs(rotation) % 180 == 90:
+        return height, width
+    return width, height
+
+
+def create_frame_pool(resolution: Tuple[int, int], pool_size: int) -> 'Queue[Frame]':
+    width, height = resolution
+    frame_pool: Queue[Frame] = Queue()
+    for _ in range(pool_size):
+        frame_pool.put(numpy.empty((height, width, 3), dtype=numpy.uint8))
+    return frame_pool
+
+
+def read_frame_into(stream: Any, frame: Frame) -> bool:
+    buffer = frame.data.cast('B')
+    position = 0
+    while position < len(buffer):
+        size = stream.readinto(buffer[position:])
+        if not size:
+            return False
+        position += size
+    return True
+
+
+def read_video_frames(target_path: str, resolution: Tuple[int, int], frame_pool: 'Queue[Frame]') -> Iterator[Frame]:
+    process = open_ffmpeg(['-hwaccel', 'auto', '-i', target_path, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'], stdout=True)
+    try:
+        while True:
+            frame = frame_pool.get()
+            if not read_frame_into(process.stdout, frame):
+                frame_pool.put(frame)
+                break
+            yield frame
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+
+def open_video_writer(target_path: str, output_path: str, resolution: Tuple[int, int], fps: float, keep_audio: bool) -> 'subprocess.Popen[bytes]':
+    width, height = resolution
+    commands = ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-']
+    if keep_audio:
+        commands.extend(['-i', target_path, '-map', '0:v:0', '-map', '1:a:0?'])
+    commands.extend(['-c:v', roop.globals.video_encoder, '-crf', str(roop.globals.video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', output_path])
+    return open_ffmpeg(commands, stdin=True)
+
+
+@profiled('ffmpeg.write', 'ffmpeg')
+def write_video_frame(writer: 'subprocess.Popen[bytes]', frame: Frame) -> None:
+    writer.stdin.write(numpy.ascontiguousarray(frame).data.cast('B'))
+
+
+def close_video_writer(writer: 'subprocess.Popen[bytes]') -> bool:
+    writer.stdin.close()
+    return writer.wait() == 0
+
+
+@profiled('ffmpeg.extract', 'ffmpeg')
 def extract_frames(target_path: str) -> None:
     temp_directory_path = get_temp_directory_path(target_path)
     run_ffmpeg(['-i', target_path, '-pix_fmt', 'rgb24', os.path.join(temp_directory_path, '%04d.png')])
 
 
+@profiled('ffmpeg.encode', 'ffmpeg')
 def create_video(target_path: str, fps: float = 30.0) -> None:
     temp_output_path = get_temp_output_path(target_path)
     temp_directory_path = get_temp_directory_path(target_path)
@@ -57,6 +137,7 @@ def create_video(target_path: str, fps: float = 30.0) -> None:
     # ffmpeg -hide_banner -hwaccel auto -loglevel error -r 30.0 -i G:/delme\\temp\\te1533...0\\%04d.png -c:v libx264 -crf 18
 
 
+@profiled('ffmpeg.audio', 'ffmpeg')
 def restore_audio(target_path: str, output_path: str) -> None:
     temp_output_path = get_temp_output_path(target_path)
     done = run_ffmpeg(['-i', temp_output_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
@@ -66,7 +147,7 @@ def restore_audio(target_path: str, output_path: str) -> None:
 
 def get_temp_frame_paths(target_path: str) -> List[str]:
     temp_directory_path = get_temp_directory_path(target_path)
-    return glob.glob((os.path.join(glob.escape(temp_directory_path), '*.png')))
+    return sorted(glob.glob((os.path.join(glob.escape(temp_directory_path), '*.png'))))
 
 
 def get_temp_directory_path(target_path: str) -> str:
@@ -152,6 +233,50 @@ def conditional_download(download_directory_path: str, urls: List[str]) -> None:
 def resolve_relative_path(path: str) -> str:
     return os.path.abspath(os.path.join(os.path.dirname(__file__), path))
 
+def get_session_options() -> Any:
+    import onnxruntime
+
+    session_options = onnxruntime.SessionOptions()
+    if roop.globals.execution_ort_threads:
+        session_options.intra_op_num_threads = roop.globals.execution_ort_threads
+        session_options.inter_op_num_threads = 1
+    return session_options
+
+
+def get_optimized_model_path(model_path: str) -> str:
+    import onnxruntime
+
+    model_name, _ = os.path.splitext(os.path.basename(model_path))
+    execution_provider = roop.globals.execution_providers[0].replace('ExecutionProvider', '').lower() if roop.globals.execution_providers else 'default'
+    return os.path.join(os.path.dirname(model_path), 'optimized', f'{model_name}.{execution_provider}.{onnxruntime.__version__}.onnx')
+
+
+def is_optimized_model_cached(model_path: str, optimized_model_path: str) -> bool:
+    return os.path.isfile(optimized_model_path) and os.path.getmtime(optimized_model_path) >= os.path.getmtime(model_path)
+
+
+def create_inference_session(model_path: str) -> Any:
+    import onnxruntime
+
+    optimized_model_path = get_optimized_model_path(model_path)
+    if is_optimized_model_cached(model_path, optimized_model_path):
+        try:
+            return onnxruntime.InferenceSession(optimized_model_path, sess_options=get_session_options(), providers=roop.globals.execution_providers)
+        except Exception:
+            with suppress(FileNotFoundError):
+                os.remove(optimized_model_path)
+    optimized_model_name, optimized_model_extension = os.path.splitext(optimized_model_path)
+    partial_model_path = f'{optimized_model_name}.{os.getpid()}-{threading.get_ident()}.partial{optimized_model_extension}'
+    session_options = get_session_options()
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    session_options.optimized_model_filepath = partial_model_path
+    Path(os.path.dirname(optimized_model_path)).mkdir(parents=True, exist_ok=True)
+    inference_session = onnxruntime.InferenceSession(model_path, sess_options=session_options, providers=roop.globals.execution_providers)
+    with suppress(FileNotFoundError):
+        os.replace(partial_model_path, optimized_model_path)
+    return inference_session
+
+
 def get_device() -> str:
     if 'CUDAExecutionProvider' in roop.globals.execution_providers:
         return 'cuda'
@@ -186,4 +311,6 @@ def open_with_default_app(filename):
 
 
 def compute_cosine_distance(emb1, emb2):
+    from scipy.spatial import distance
+
     return distance.cosine(emb1, emb2)
@@ -0,0 +1,59 @@
+from typing import Any
+
+import cv2
+import numpy
+import pytest
+from insightface.utils import face_align
+
+from roop.processors.frame.face_swapper import paste_back
+from roop.typing import Frame
+
+FACE_TEMPLATE = numpy.array([[38.2946, 51.6963], [73.5318, 51.5014], [56.0252, 71.7366], [41.5493, 92.3655], [70.7299, 92.2041]], dtype=numpy.float32)
+FRAME_SIZE = (640, 480)
+MAX_TOLERANCE = 1
+MEAN_TOLERANCE = 0.01
+
+
+def paste_back_full_frame(temp_frame: Frame, swapped_frame: Frame, crop_frame: Frame, affine_matrix: Any) -> Frame:
+    frame_height, frame_width = temp_frame.shape[:2]
+    inverse_matrix = cv2.invertAffineTransform(affine_matrix)
+    crop_mask = numpy.full(crop_frame.shape[:2], 255, dtype=numpy.float32)
+    swapped_frame = cv2.warpAffine(swapped_frame, inverse_matrix, (frame_width, frame_height), borderValue=0.0)
+    crop_mask = cv2.warpAffine(crop_mask, inverse_matrix, (frame_width, frame_height), borderValue=0.0)
+    crop_mask[crop_mask > 20] = 255
+    mask_h_inds, mask_w_inds = numpy.where(crop_mask == 255)
+    mask_size = int(numpy.sqrt((numpy.max(mask_h_inds) - numpy.min(mask_h_inds)) * (numpy.max(mask_w_inds) - numpy.min(mask_w_inds))))
+    erode_size = max(mask_size // 10, 10)
+    crop_mask = cv2.erode(crop_mask, numpy.ones((erode_size, erode_size), numpy.uint8), iterations=1)
+    blur_size = max(mask_size // 20, 5) * 2 + 1
+    crop_mask = cv2.GaussianBlur(crop_mask, (blur_size, blur_size), 0)
+    crop_mask = numpy.reshape(crop_mask / 255, [crop_mask.shape[0], crop_mask.shape[1], 1])
+    return (crop_mask * swapped_frame + (1 - crop_mask) * temp_frame.astype(numpy.float32)).astype(numpy.uint8)
+
+
+def create_kps(center_x: float, center_y: float, face_size: float, angle: float) -> Any:
+    rotation = cv2.getRotationMatrix2D((56, 56), angle, face_size / 112)
+    rotation[:, 2] += (center_x - 56, center_y - 56)
+    return cv2.transform(FACE_TEMPLATE[None], rotation)[0]
+
+
+@pytest.mark.parametrize('center_x, center_y, face_size, angle', [
+    (320, 240, 200, 0),
+    (320, 240, 300, 35),
+    (320, 240, 450, 15),
+    (200, 300, 40, -20),
+    (30, 40, 180, 10),
+    (610, 450, 220, -45),
+    (-40, 240, 160, 0),
+    (320, 500, 260, 90)
+])
+def test_paste_back_matches_full_frame(center_x: float, center_y: float, face_size: float, angle: float) -> None:
+    random = numpy.random.RandomState(0)
+    temp_frame = random.randint(0, 256, (FRAME_SIZE[1], FRAME_SIZE[0], 3), dtype=numpy.uint8)
+    swapped_frame = random.randint(0, 256, (128, 128, 3), dtype=numpy.uint8)
+    crop_frame, affine_matrix = face_align.norm_crop2(temp_frame, create_kps(center_x, center_y, face_size, angle), 128)
+    expected_frame = paste_back_full_frame(temp_frame, swapped_frame, crop_frame, affine_matrix)
+    result_frame = paste_back(temp_frame.copy(), swapped_frame, crop_frame, affine_matrix)
+    difference = numpy.abs(result_frame.astype(numpy.int16) - expected_frame.astype(numpy.int16))
+    assert difference.max() <= MAX_TOLERANCE
+    assert difference.mean() <= MEAN_TOLERANCE